@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import json
+import platform
+import random
+import subprocess
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from io import BytesIO
+from pathlib import Path
+from statistics import mean, median
+from time import perf_counter
+
+from common import get_quotes
+from quotes2images import STYLES, Quote2Image, Quote2ImageException, surface_to_image
+
+STAGES = ['font_size_search', 'rendering', 'grayscale_conversion', 'png_encode']
+
+SYNTHETIC_TEXT = ("The clock on the mantelpiece ticked on, patient and unhurried, while the rain kept drumming against "
+                  "the windows of the little room and nobody dared to say a word. ")
+
+
+def get_args():
+    parser = ArgumentParser(
+        prog='benchmark',
+        description='Measure the performance of the stages of the quote to image pipeline.',
+    )
+    parser.add_argument('src', help='source file containing quotes in yaml format', type=Path)
+    parser.add_argument('-o', help='write the results in json format to this file (default: stdout)', type=Path,
+                        default=None, dest='output')
+    parser.add_argument('-count', help='number of quotes per subset (default=200)', type=int, default=200)
+    parser.add_argument('-seed', help='seed for the random corpus subset (default=0)', type=int, default=0)
+    parser.add_argument('-load-repeat', help='number of times the yaml file and its compiled cache are loaded '
+                                             '(default=3)', type=int, default=3)
+    parser.add_argument('-width', help='image width', type=int, default=600)
+    parser.add_argument('-height', help='image height', type=int, default=800)
+    parser.add_argument('--compare-reuse', help='also compare a new Quote2Image per quote with a reused one',
+                        action='store_true')
+
+    return vars(parser.parse_args())
+
+
+def to_record(data):
+    return data['quote'], str(data['timestring']), data['title'], data['author']
+
+
+def get_subsets(quotes_dict, count, seed):
+    """fixed subsets of the corpus and synthetic short and long quotes"""
+    records = [to_record(data) for timestr in sorted(quotes_dict) for data in quotes_dict[timestr]]
+    synthetic_short = [(f"It was {h} o'clock.", f"{h} o'clock", "Short Stories", "Anonymous")
+                       for h in ['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten']]
+    synthetic_long = [(SYNTHETIC_TEXT * n + f"Then the clock struck {h}.", h, "A Very Long Novel", "Anonymous")
+                      for n in [3, 4, 5] for h in ['one', 'two', 'three']]
+
+    return {
+        'corpus_first': records[:count],
+        'corpus_random': random.Random(seed).sample(records, min(count, len(records))),
+        'synthetic_short': (synthetic_short * count)[:count],
+        'synthetic_long': (synthetic_long * count)[:count],
+    }
+
+
+def summarize(durations):
+    return {
+        'total_s': sum(durations),
+        'mean_ms': mean(durations) * 1000,
+        'median_ms': median(durations) * 1000,
+        'max_ms': max(durations) * 1000,
+    }
+
+
+def load_quotes(src, use_cache=True):
+    # the timestrings are not checked as in find_duplicates (litclock_annotated.yaml has timestrings which are not in
+    # their quote, those quotes are rendered without highlighting)
+    return get_quotes(src, fix_timestring_case=True, use_cache=use_cache)
+
+
+def bench_load(src, repeat, use_cache=False):
+    """time loading the quotes: parsing the yaml file or reading the compiled corpus cache"""
+    if use_cache:
+        load_quotes(src)  # create the cache
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter()
+        load_quotes(src, use_cache=use_cache)
+        durations.append(perf_counter() - start)
+    return summarize(durations)
+
+
+def bench_stages(quotes, width, height):
+    """render quotes with one Quote2Image and time each stage of the pipeline separately"""
+    q2i = Quote2Image(width, height, STYLES['default'])
+    q2i.add_quote(*quotes[0][:2])  # warm up font loading
+
+    durations = {stage: [] for stage in STAGES}
+    layout_passes, failed = [], 0
+    for quote, timestr, title, author in quotes:
+        t0 = perf_counter()
+        q2i._prepare_quote(quote, timestr)
+        try:
+            q2i._find_font_size()
+        except Quote2ImageException:
+            failed += 1
+            continue
+        t1 = perf_counter()
+        q2i._render_quote()
+        q2i.add_annotations(title, author)
+        t2 = perf_counter()
+        image = surface_to_image(q2i.surface, grayscale=True)
+        t3 = perf_counter()
+        image.save(BytesIO(), format='PNG')
+        t4 = perf_counter()
+
+        for stage, duration in zip(STAGES, [t1 - t0, t2 - t1, t3 - t2, t4 - t3]):
+            durations[stage].append(duration)
+        layout_passes.append(len(q2i.iterations))
+
+    result = {'quotes': len(quotes), 'failed': failed}
+    if layout_passes:
+        result['layout_passes_per_quote'] = mean(layout_passes)
+        result.update({stage: summarize(durations[stage]) for stage in STAGES})
+    return result
+
+
+def bench_renderer(quotes, width, height, reuse):
+    """render all quotes with one Quote2Image (reuse) or with a new Quote2Image per quote"""
+    q2i = Quote2Image(width, height, STYLES['default'])
+    q2i.add_quote(*quotes[0][:2])  # warm up font loading
+
+    surfaces, last_surface = 0, None
+    tracemalloc.start()
+    start = perf_counter()
+    for quote, timestr, title, author in quotes:
+        if not reuse:
+            q2i = Quote2Image(width, height, STYLES['default'])
+        q2i.add_quote(quote, timestr)
+        q2i.add_annotations(title, author)
+        if q2i.surface is not last_surface:
+            surfaces, last_surface = surfaces + 1, q2i.surface
+    duration = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'quotes': len(quotes),
+        'time_per_quote_ms': duration / len(quotes) * 1000,
+        'surfaces_per_quote': surfaces / len(quotes),
+        'surface_kib_per_quote': surfaces * q2i.surface.get_stride() * height / len(quotes) / 1024,
+        'python_peak_kib': peak / 1024,
+    }
+
+
+def get_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=Path(__file__).parent)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    results = {
+        'commit': get_commit(),
+        'python': sys.version.split()[0],
+        'machine': platform.machine(),
+        'width': args['width'],
+        'height': args['height'],
+        'yaml_load': bench_load(args['src'], args['load_repeat']),
+        'compiled_load': bench_load(args['src'], args['load_repeat'], use_cache=True),
+        'subsets': {},
+    }
+
+    subsets = get_subsets(load_quotes(args['src']), args['count'], args['seed'])
+    for name, quotes in subsets.items():
+        print(f"{name}...", file=sys.stderr)
+        results['subsets'][name] = bench_stages(quotes, args['width'], args['height'])
+
+    if args['compare_reuse']:
+        quotes = subsets['corpus_first']
+        results['renderer'] = {
+            'new_per_quote': bench_renderer(quotes, args['width'], args['height'], reuse=False),
+            'reused': bench_renderer(quotes, args['width'], args['height'], reuse=True),
+        }
+
+    if args['output'] is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args['output'], 'w') as output_file:
+            json.dump(results, output_file, indent=2)
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
+import json
+import os
+import sys
 from argparse import ArgumentParser
+from multiprocessing import Pool
 from pathlib import Path
 
-from common import get_quotes, minute_to_timestr
+from common import ANNOTATION_MARGIN, AREA_PER_CHAR, DEFAULT_MARGIN, FONT_SIZE_MIN, get_quotes, iter_checked_quotes, \
+    minute_to_timestr, timestr_to_minute
 
 
 def get_args():
@@ -12,13 +17,154 @@ def get_args():
     )
     parser.add_argument('src', help='source yaml', type=Path)
     parser.add_argument('--statistics', help='show statistics', action='store_true')
+    parser.add_argument('--stream', help='report errors of each minute while parsing the yaml', action='store_true')
+    parser.add_argument('--analytics', help='show coverage, quote length and font size statistics (requires numpy)',
+                        action='store_true')
+    parser.add_argument('-json', help='write the analytics to this file in json format', type=Path, default=None)
+    parser.add_argument('--fit-check', help='list quotes which do not fit into the image at the minimum font size '
+                                            '(measures the text like quotes2images without rendering it)',
+                        action='store_true')
+    parser.add_argument('-jobs', help='number of parallel processes for the fit check (0: one per CPU, default=0)',
+                        type=int, default=0)
+    parser.add_argument('-width', help='image width for the font size prediction and fit check', type=int,
+                        default=600)
+    parser.add_argument('-height', help='image height for the font size prediction and fit check', type=int,
+                        default=800)
 
     return vars(parser.parse_args())
 
 
+RISK_MARGIN = 1.1  # quotes with a predicted font size below FONT_SIZE_MIN * RISK_MARGIN are at risk
+PERCENTILES = [0, 10, 25, 50, 75, 90, 99, 100]
+
+
+def get_columns(quotes: dict):
+    """one array per attribute of all quotes"""
+    import numpy as np  # only needed for the analytics
+
+    records = [(timestr_to_minute(str(t)), record) for t, datasets in quotes.items() for record in datasets]
+    authors, author_ids = np.unique([str(r.get('author')) for _, r in records], return_inverse=True)
+    titles, title_ids = np.unique([str(r.get('title')) for _, r in records], return_inverse=True)
+    return {
+        'minute': np.array([minute for minute, _ in records], dtype=np.int32),
+        'length': np.array([len(str(r.get('quote', ''))) for _, r in records], dtype=np.int32),
+        'author': author_ids, 'authors': authors,
+        'title': title_ids, 'titles': titles,
+    }
+
+
+def get_analytics(columns: dict, width: int, height: int, top=10):
+    import numpy as np
+
+    minute, length = columns['minute'], columns['length']
+    per_minute = np.bincount(minute, minlength=24 * 60)
+    per_count = np.bincount(per_minute)
+
+    # same prediction as Quote2Image._predict_font_size
+    area = (height - DEFAULT_MARGIN - ANNOTATION_MARGIN) * (width - 2 * DEFAULT_MARGIN)
+    font_size = np.sqrt(area / (AREA_PER_CHAR * np.maximum(length, 1)))
+    at_risk = np.flatnonzero(font_size < FONT_SIZE_MIN * RISK_MARGIN)
+    at_risk = at_risk[np.argsort(font_size[at_risk])]
+
+    def concentration(ids, names):
+        counts = np.bincount(ids, minlength=len(names))
+        order = np.argsort(-counts, kind='stable')[:top]
+        return {
+            'distinct': len(names),
+            'top_share': float(counts[order].sum() / max(len(ids), 1)),
+            'top': [[str(names[i]), int(counts[i])] for i in order],
+        }
+
+    return {
+        'quotes': len(minute),
+        'coverage': {
+            'minutes_with_quotes': int(np.count_nonzero(per_minute)),
+            'missing_minutes': [minute_to_timestr(int(m)) for m in np.flatnonzero(per_minute == 0)],
+            'single_quote_minutes': int(np.count_nonzero(per_minute == 1)),
+            'minutes_per_quote_count': {str(count): int(n) for count, n in enumerate(per_count) if n},
+            'minutes_with_quotes_per_hour': per_minute.reshape(24, 60).astype(bool).sum(axis=1).tolist(),
+        },
+        'length_percentiles': dict(zip(map(str, PERCENTILES), np.percentile(length, PERCENTILES).tolist())),
+        'predicted_font_size_percentiles': dict(zip(map(str, PERCENTILES),
+                                                    np.percentile(font_size, PERCENTILES).round(1).tolist())),
+        'authors': concentration(columns['author'], columns['authors']),
+        'titles': concentration(columns['title'], columns['titles']),
+        'at_risk': [{
+            'time': minute_to_timestr(int(minute[i])), 'length': int(length[i]),
+            'predicted_font_size': round(float(font_size[i]), 1),
+            'author': str(columns['authors'][columns['author'][i]]),
+            'title': str(columns['titles'][columns['title'][i]]),
+        } for i in at_risk],
+    }
+
+
+_fit_checker = None  # Quote2Image of the current process (see init_fit_check)
+
+
+def init_fit_check(width, height):
+    global _fit_checker
+    from quotes2images import STYLES, Quote2Image
+    _fit_checker = Quote2Image(width, height, STYLES['default'], measure_only=True)
+
+
+def fit_check_job(job):
+    _, record = job
+    return _fit_checker.fits(record['quote'], str(record['timestring']))
+
+
+def fit_check(quotes: dict, width: int, height: int, jobs=1):
+    """find the quotes which do not fit at the minimum font size - returns a list of (time, record)"""
+    records = [(t, record) for t, datasets in quotes.items() for record in datasets]
+    if jobs > 1:
+        with Pool(jobs, initializer=init_fit_check, initargs=(width, height)) as pool:
+            results = pool.map(fit_check_job, records, chunksize=64)
+    else:
+        init_fit_check(width, height)
+        results = list(map(fit_check_job, records))
+    return [(t, record) for (t, record), ok in zip(records, results) if not ok]
+
+
+def print_analytics(analytics: dict):
+    coverage = analytics['coverage']
+    print(f"quotes: {analytics['quotes']}")
+    print(f"minutes with quotes: {coverage['minutes_with_quotes']} of {24 * 60} "
+          f"({len(coverage['missing_minutes'])} missing, {coverage['single_quote_minutes']} with a single quote)")
+    print("minutes by number of quotes: " +
+          ', '.join(f"{count}: {n}" for count, n in coverage['minutes_per_quote_count'].items()))
+    print("minutes with quotes per hour: " +
+          ' '.join(f"{h:02d}h:{n}" for h, n in enumerate(coverage['minutes_with_quotes_per_hour'])))
+
+    print(f"\n{'percentile':>10} {'length':>8} {'font size':>10}")
+    for p in analytics['length_percentiles']:
+        print(f"{p:>10} {analytics['length_percentiles'][p]:>8.0f} "
+              f"{analytics['predicted_font_size_percentiles'][p]:>10.1f}")
+
+    for key in ['authors', 'titles']:
+        concentration = analytics[key]
+        print(f"\n{key}: {concentration['distinct']} distinct, top {len(concentration['top'])} "
+              f"have {concentration['top_share']:.1%} of the quotes")
+        for name, count in concentration['top']:
+            print(f"  {count:>5} {name}")
+
+    print(f"\n{len(analytics['at_risk'])} quotes at risk of a font size below the minimum:")
+    for r in analytics['at_risk']:
+        print(f"  {r['time']} {r['predicted_font_size']:>5.1f} ({r['length']} chars) {r['title']}, {r['author']}")
+
+
 if __name__ == '__main__':
     args = get_args()
-    quotes = get_quotes(args['src'], collect_errors=True)
+    if args['stream']:
+        quotes, error_count = {}, 0
+        for time, datasets, errors in iter_checked_quotes(args['src']):
+            quotes[time] = datasets
+            for e in errors:
+                print(f"{time}: {e}", flush=True)
+            error_count += len(errors)
+        if error_count:
+            print(f"{error_count} Errors in quotes")
+            sys.exit(1)
+    else:
+        quotes = get_quotes(args['src'], collect_errors=True)
     print("all quotes ok")
     
     if args['statistics']:
@@ -33,4 +179,21 @@ if __name__ == '__main__':
         if missing:
             print(f"missing: {missing})")
 
+    if args['analytics'] or args['json']:
+        analytics = get_analytics(get_columns(quotes), args['width'], args['height'])
+        if args['analytics']:
+            print_analytics(analytics)
+        if args['json']:
+            with open(args['json'], 'w', encoding='utf8') as json_file:
+                json.dump(analytics, json_file, indent=2, ensure_ascii=False)
+
+    if args['fit_check']:
+        failing = fit_check(quotes, args['width'], args['height'], args['jobs'] or os.cpu_count() or 1)
+        for time, record in failing:
+            print(f"{time}: does not fit: {record['title']}, {record['author']} ({len(record['quote'])} chars)")
+        if failing:
+            print(f"{len(failing)} quotes do not fit at the minimum font size")
+            sys.exit(1)
+        print("all quotes fit")
+
 
@@ -1,13 +1,55 @@
+import json
+import os
 import re
+import sqlite3
+from hashlib import sha1
+from pathlib import Path
 
 import yaml
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
+from yaml.resolver import Resolver
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+    from yaml.cyaml import CParser
+except ImportError:  # PyYAML without libyaml
+    from yaml import SafeLoader
+    CParser = None
+
+COMPILED_SUFFIX = '.sqlite'
+COMPILED_VERSION = '1'
+
+
+EXPECTED_KEYS = ['author', 'quote', 'timestring', 'title']
+
+# image layout (here, so the quote checks can predict font sizes without the rendering libraries)
+DEFAULT_MARGIN = 26
+ANNOTATION_MARGIN = 100
+FONT_SIZE_MIN = 19
+FONT_SIZE_MAX = None
+AREA_PER_CHAR = 1.1  # text area per character in units of font_size² before any quote is solved (see Quote2Image)
 
 
 class Quote(str):
     pass
 
 
-def write_yaml(content, dst_file):
+class QuoteDumper(yaml.Dumper):
+    # Note: the libyaml emitter (CDumper) folds non-ascii text differently and escapes characters outside the BMP,
+    # so the pure python dumper is used to keep the output format stable.
+    pass
+
+
+def quote_presenter(dumper, data):
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='>')
+
+
+QuoteDumper.add_representer(Quote, quote_presenter)
+
+
+def dump_quotes(content, yaml_file):
+    """write quotes to an open file (consecutive calls with different times result in one mapping)"""
     # mark quotes
     def mark_quote(d):
         d['quote'] = Quote(d['quote'])
@@ -16,43 +58,186 @@ def write_yaml(content, dst_file):
     for t, elms in content.items():
         content[t] = [mark_quote(item) for item in elms]
 
-    def quote_presenter(dumper, data):
-        return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='>')
+    yaml.dump(content, yaml_file, Dumper=QuoteDumper, allow_unicode=True)
 
-    yaml.add_representer(Quote, quote_presenter)
 
+def write_yaml(content, dst_file):
     with open(dst_file, 'w') as yaml_file:
-        yaml.dump(content, yaml_file, allow_unicode=True)
+        dump_quotes(content, yaml_file)
+
+
+if CParser is not None:
+    class StreamLoader(CParser, Composer, SafeConstructor, Resolver):
+        """safe loader which parses with libyaml but allows to compose and construct the document node by node"""
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            Composer.__init__(self)
+            SafeConstructor.__init__(self)
+            Resolver.__init__(self)
+else:
+    StreamLoader = SafeLoader
+
+
+def iter_yaml(src_file):
+    """parse a quote file minute by minute - yields (time, datasets) as soon as a minute block has been parsed"""
+    with open(src_file, newline='\n', encoding="utf8") as yaml_file:
+        loader = StreamLoader(yaml_file)
+        try:
+            loader.get_event()  # stream start
+            if loader.check_event(yaml.StreamEndEvent):
+                return  # empty file
+            loader.get_event()  # document start
+            if not loader.check_event(yaml.MappingStartEvent):
+                raise Exception(f"Expected a mapping of times to quotes in {src_file}")
+            loader.get_event()
+
+            while not loader.check_event(yaml.MappingEndEvent):
+                t = loader.construct_object(loader.compose_node(None, None), deep=True)
+                datasets = loader.construct_object(loader.compose_node(None, None), deep=True)
+                loader.constructed_objects = {}
+                yield t, datasets
+        finally:
+            loader.dispose()
+
+
+def check_datasets(datasets, fix_timestring_case=False):
+    """check the quotes of one minute - returns the list of errors found"""
+    errors = []
+    for dataset in datasets:
+        missing_keys = [key for key in EXPECTED_KEYS if key not in dataset]
+        if missing_keys:
+            errors.append(Exception(f"Missing key in {dataset} (expected {EXPECTED_KEYS})"))
+            continue
+
+        timestring, quote = str(dataset['timestring']), dataset['quote']
+        if timestring not in quote:
+            if fix_timestring_case:
+                search_result = re.search(timestring, quote, re.IGNORECASE)
+                if search_result:
+                    dataset['timestring'] = search_result.group()
+            else:
+                errors.append(Exception(f"Timestring '{timestring}' not found in quote '{quote}'"))
+    return errors
+
+
+def iter_checked_quotes(src_file, fix_timestring_case=False):
+    """streaming validation: yields (time, datasets, errors) for each minute block while parsing"""
+    for t, datasets in iter_yaml(src_file):
+        yield t, datasets, check_datasets(datasets, fix_timestring_case)
+
+
+class CompiledCorpus:
+    """
+    Quotes in a sqlite database (one row per quote, indexed by time).
 
+    Used as cache of a yaml source file (see open_corpus) or as standalone corpus file.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path)
 
-def get_quotes(src_file, collect_errors=False, fix_timestring_case=False):
+    @classmethod
+    def create(cls, path, quotes, source_info: dict = None):
+        """write a corpus from a dict of time -> datasets or an iterable of (time, datasets)"""
+        items = quotes.items() if isinstance(quotes, dict) else quotes
+        path = Path(path)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.unlink(missing_ok=True)
+        with sqlite3.connect(tmp) as connection:
+            connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE quotes (time TEXT, data TEXT)")
+            connection.execute("CREATE INDEX quotes_time ON quotes (time)")
+            connection.executemany("INSERT INTO meta VALUES (?, ?)",
+                                   [('version', COMPILED_VERSION)] + list((source_info or {}).items()))
+            connection.executemany("INSERT INTO quotes VALUES (?, ?)",
+                                   ((t, json.dumps(dataset, ensure_ascii=False))
+                                    for t, datasets in items for dataset in datasets))
+        connection.close()
+        tmp.replace(path)
+        return cls(path)
+
+    def get_meta(self):
+        return dict(self.connection.execute("SELECT key, value FROM meta"))
+
+    def get(self, timestr, default=None):
+        rows = self.connection.execute("SELECT data FROM quotes WHERE time = ? ORDER BY rowid", (timestr,)).fetchall()
+        return [json.loads(data) for data, in rows] if rows else default
+
+    def get_all(self):
+        result = {}
+        for t, data in self.connection.execute("SELECT time, data FROM quotes ORDER BY rowid"):
+            result.setdefault(t, []).append(json.loads(data))
+        return result
+
+    def close(self):
+        self.connection.close()
+
+
+def get_source_info(src_file, with_hash=True):
+    stat = os.stat(src_file)
+    info = {'source_mtime_ns': str(stat.st_mtime_ns), 'source_size': str(stat.st_size)}
+    if with_hash:
+        with open(src_file, 'rb') as f:
+            info['source_sha1'] = sha1(f.read()).hexdigest()
+    return info
+
+
+def load_yaml(src_file):
     with open(src_file, newline='\n', encoding="utf8") as yaml_file:
-        result = yaml.safe_load(yaml_file)
+        return yaml.load(yaml_file, Loader=SafeLoader)
+
+
+def open_corpus(src_file):
+    """
+    Open the compiled version of a quote file.
+
+    For yaml files the compiled corpus is stored next to the source and rebuilt if the source has changed.
+    """
+    src_file = Path(src_file)
+    if src_file.suffix == COMPILED_SUFFIX:
+        return CompiledCorpus(src_file)
+
+    cache_file = src_file.with_name(src_file.name + COMPILED_SUFFIX)
+    if cache_file.exists():
+        try:
+            corpus = CompiledCorpus(cache_file)
+            meta = corpus.get_meta()
+            if meta.get('version') == COMPILED_VERSION:
+                info = get_source_info(src_file, with_hash=False)
+                if all(meta.get(k) == v for k, v in info.items()):
+                    return corpus
+                # modification time changed - check if the content did change as well
+                info = get_source_info(src_file)
+                if meta.get('source_sha1') == info['source_sha1']:
+                    corpus.connection.executemany("UPDATE meta SET value = ? WHERE key = ?",
+                                                  [(v, k) for k, v in info.items()])
+                    corpus.connection.commit()
+                    return corpus
+            corpus.close()
+        except sqlite3.Error:
+            pass
+
+    info = get_source_info(src_file)
+    return CompiledCorpus.create(cache_file, load_yaml(src_file), info)
+
+
+def get_quotes(src_file, collect_errors=False, fix_timestring_case=False, use_cache=True):
+    if use_cache:
+        try:
+            corpus = open_corpus(src_file)
+            result = corpus.get_all()
+            corpus.close()
+        except (OSError, sqlite3.Error):  # e.g. no write access to the folder of the source file
+            result = load_yaml(src_file)
+    else:
+        result = load_yaml(src_file)
 
     exceptions = []
-    expected_keys = ['author', 'quote', 'timestring', 'title']
     for t, datasets in result.items():
-        for dataset in datasets:
-            for key in expected_keys:
-                if key not in dataset:
-                    e = Exception(f"Missing key in {dataset} (expected {expected_keys})")
-                    if collect_errors:
-                        exceptions.append(e)
-                    else:
-                        raise e
-
-            timestring, quote = str(dataset['timestring']), dataset['quote']
-            if timestring not in quote:
-                if fix_timestring_case:
-                    search_result = re.search(timestring, quote, re.IGNORECASE)
-                    if search_result:
-                        dataset['timestring'] = search_result.group()
-                else:
-                    e = Exception(f"Timestring '{timestring}' not found in quote '{quote}'")
-                    if collect_errors:
-                        exceptions.append(e)
-                    else:
-                        raise e
+        errors = check_datasets(datasets, fix_timestring_case)
+        if errors and not collect_errors:
+            raise errors[0]
+        exceptions.extend(errors)
 
     if not exceptions or fix_timestring_case:
         return result
@@ -61,6 +246,102 @@ def get_quotes(src_file, collect_errors=False, fix_timestring_case=False):
     raise Exception(f"{len(exceptions)} Errors in quotes:\n{es}")
 
 
+class Corpus:
+    """
+    Lazy access to the quotes of a quote file: the quotes of a minute are only parsed and checked when requested.
+
+    Yaml files are indexed with the positions of the minute blocks reported by the yaml parser (without constructing
+    the quotes), compiled corpus files (see CompiledCorpus) are queried per minute.
+    """
+    def __init__(self, src_file, fix_timestring_case=False):
+        self.src_file = Path(src_file)
+        self.fix_timestring_case = fix_timestring_case
+        self.compiled = CompiledCorpus(self.src_file) if self.src_file.suffix == COMPILED_SUFFIX else None
+        self.offsets = self._build_index() if self.compiled is None else None  # time -> (start, end)
+        self.quotes = {}  # parsed minutes
+
+    def _build_index(self):
+        """byte offsets of the minute blocks (from the start of a key to the end of its value) reported by the parser"""
+        with open(self.src_file, newline='\n', encoding="utf8") as yaml_file:
+            text = yaml_file.read()
+        spans = {}  # time -> (start, end) in characters
+        loader = StreamLoader(text)
+        try:
+            loader.get_event()  # stream start
+            if loader.check_event(yaml.StreamEndEvent):
+                return {}  # empty file
+            loader.get_event()  # document start
+            if not loader.check_event(yaml.MappingStartEvent):
+                raise Exception(f"Expected a mapping of times to quotes in {self.src_file}")
+            loader.get_event()
+
+            while not loader.check_event(yaml.MappingEndEvent):
+                # let yaml interpret the key (quoting, sexagesimal numbers)
+                key_node = loader.compose_node(None, None)
+                key = str(loader.construct_object(key_node))
+                spans[key] = (key_node.start_mark.index, self._skip_node(loader))
+        finally:
+            loader.dispose()
+
+        # the parser counts characters, the blocks are read from the file by byte offsets
+        byte_offsets, char_position, byte_position = {}, 0, 0
+        for position in sorted({position for span in spans.values() for position in span}):
+            byte_position += len(text[char_position:position].encode('utf8'))
+            byte_offsets[position], char_position = byte_position, position
+        return {key: (byte_offsets[start], byte_offsets[end]) for key, (start, end) in spans.items()}
+
+    @staticmethod
+    def _skip_node(loader):
+        """skip the events of the next node - returns its end position"""
+        depth = 0
+        while True:
+            event = loader.get_event()
+            if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+                depth += 1
+            elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                depth -= 1
+            if depth == 0:
+                return event.end_mark.index
+
+    def _load(self, timestr):
+        if self.compiled is not None:
+            return self.compiled.get(timestr)
+        if timestr not in self.offsets:
+            return None
+        start, end = self.offsets[timestr]
+        with open(self.src_file, 'rb') as yaml_file:
+            yaml_file.seek(start)
+            block = yaml_file.read(end - start)
+        return next(iter(yaml.load(block, Loader=SafeLoader).values())) or []
+
+    def get(self, timestr, default=None, check=True):
+        """the quotes of a minute (raises the first error found in them, unless check is False)"""
+        if not check and timestr not in self.quotes:
+            datasets = self._load(timestr)  # not cached, the next checked access raises the errors again
+            return default if datasets is None else datasets
+        if timestr not in self.quotes:
+            datasets = self._load(timestr)
+            if datasets is not None:
+                errors = check_datasets(datasets, self.fix_timestring_case)
+                if errors and not self.fix_timestring_case:
+                    raise errors[0]
+            self.quotes[timestr] = datasets
+        datasets = self.quotes[timestr]
+        return default if datasets is None else datasets
+
+    def iter_range(self, start_minute=0, stop_minute=24 * 60 - 1):
+        """yields (time, datasets) for all minutes with quotes between start and stop (inclusive)"""
+        for minute in range(start_minute, stop_minute + 1):
+            timestr = minute_to_timestr(minute)
+            datasets = self.get(timestr)
+            if datasets is not None:
+                yield timestr, datasets
+
+    def close(self):
+        if self.compiled is not None:
+            self.compiled.close()
+
+
 def minute_to_timestr(minute: int):
     h, m = divmod(minute, 60)
     return f"{h:02d}:{m:02d}"
@@ -1,11 +1,19 @@
 #!/usr/bin/env python
+import re
+import zlib
 from argparse import ArgumentParser
 from collections import defaultdict
-from difflib import SequenceMatcher
 from pathlib import Path
 
+import numpy as np
+
 from common import get_quotes, write_yaml
 
+SHINGLE_SIZE = 3  # number of words per shingle
+NUM_PERM = 128  # number of hash functions of the MinHash signature
+MIDPOINT_RATIO = 0.8  # the bands make pairs at this ratio of the threshold candidates with a probability of 0.5
+WORD_PATTERN = re.compile(r'\w+')
+
 
 def get_args():
     parser = ArgumentParser(
@@ -13,38 +21,123 @@ def get_args():
         description='Find duplicates in Literature Clock quote file in yaml format.',
     )
     parser.add_argument('src', help='source yaml', type=Path)
+    parser.add_argument('-threshold', help='minimum similarity (jaccard index of word shingles) of duplicates '
+                                           '(default=0.5)', type=float, default=0.5)
+    parser.add_argument('-dst', help='write the quotes without duplicates (of the same time) to this yaml file',
+                        type=Path, default=None)
+    parser.add_argument('--remove-across-times', help='with -dst: also remove duplicates filed under different times',
+                        action='store_true')
+    parser.add_argument('--interactive', help='wait for ENTER after each duplicate', action='store_true')
+
+    return vars(parser.parse_args())
+
+
+def get_shingles(text: str):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def jaccard(a: set, b: set):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class MinHashLSH:
+    """
+    Locality sensitive hashing of MinHash signatures: sets with a jaccard index above (approximately) the threshold
+    share at least one band of their signatures and thus become candidates (which have to be verified).
+    """
+    def __init__(self, threshold, num_perm=NUM_PERM, seed=1):
+        # multiply-shift hash functions: (a * h + b) mod 2^64, the upper 32 bits are the hash (a is odd)
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+        self.bands, self.rows = self._get_bands(threshold, num_perm)
+        self.buckets = defaultdict(list)
+
+    @staticmethod
+    def _get_bands(threshold, num_perm):
+        # the probability to become a candidate is 0.5 at a similarity of about (1 / bands) ** (1 / rows), choose
+        # the strictest configuration with this point clearly below the threshold (the candidates are verified, but
+        # missed pairs are lost)
+        options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1)]
+        below = [(b, r) for b, r in options if (1 / b) ** (1 / r) <= MIDPOINT_RATIO * threshold]
+        return max(below, key=lambda o: (1 / o[0]) ** (1 / o[1])) if below else options[0]
+
+    def get_signature(self, shingles: set):
+        hashes = np.array([zlib.crc32(shingle.encode('UTF-8')) for shingle in shingles], dtype=np.uint64)
+        return ((np.outer(self.a, hashes) + self.b[:, None]) >> np.uint64(32)).min(axis=1)
+
+    def add(self, key, shingles: set):
+        signature = self.get_signature(shingles)
+        for band in range(self.bands):
+            self.buckets[band, signature[band * self.rows:(band + 1) * self.rows].tobytes()].append(key)
 
-    args = parser.parse_args()
+    def get_candidates(self):
+        candidates = set()
+        for keys in self.buckets.values():
+            for i, key in enumerate(keys):
+                for other in keys[i + 1:]:
+                    candidates.add((other, key) if other < key else (key, other))
+        return candidates
 
-    return args.src
+
+def find_duplicates(records, threshold):
+    """find similar quotes in a list of (time, record) - returns a sorted list of (index, index, similarity)"""
+    shingles = [get_shingles(record['quote']) for _, record in records]
+
+    lsh = MinHashLSH(threshold)
+    for i, s in enumerate(shingles):
+        lsh.add(i, s)
+
+    duplicates = []
+    for i, j in lsh.get_candidates():
+        similarity = jaccard(shingles[i], shingles[j])
+        if similarity >= threshold:
+            duplicates.append((i, j, similarity))
+    return sorted(duplicates)
+
+
+def remove_duplicates(records, duplicates):
+    """keep only the first record of each group of duplicates - returns a dict of time -> records"""
+    # union-find: map every record to the first record of its group
+    first = list(range(len(records)))
+
+    def find(i):
+        while first[i] != i:
+            first[i] = first[first[i]]
+            i = first[i]
+        return i
+
+    for i, j, _ in duplicates:
+        a, b = find(i), find(j)
+        first[max(a, b)] = min(a, b)
+
+    result = {}
+    for i, (time, record) in enumerate(records):
+        if find(i) == i:
+            result.setdefault(time, []).append(record)
+    return result
 
 
 if __name__ == '__main__':
-    src = get_args()
-    quotes = get_quotes(src, fix_timestring_case=True)
-    duplicates = defaultdict(lambda: [])
-
-    for time, records in quotes.items():
-        seen_quotes = []
-        for record in records:
-            for seen in seen_quotes:
-                for attr in ['timestring', 'author', 'title']:
-                    if seen[attr] != record[attr]:
-                        break
-                else:
-                    ratio = SequenceMatcher(None, record['quote'], seen['quote']).ratio()
-                    if ratio > 0.5:
-                        duplicates[time].append((record, seen))
-            seen_quotes.append(record)
-
-    count = 0
-    for time, dups in duplicates.items():
-        print(f"{time}:")
-        for duplicate in dups:
-            count += 1
-            print(f"  {duplicate[0]}")
-            print(f"  {duplicate[1]}")
+    args = get_args()
+    quotes = get_quotes(args['src'], fix_timestring_case=True)
+
+    records = [(time, record) for time, datasets in quotes.items() for record in datasets]
+    duplicates = find_duplicates(records, args['threshold'])
+
+    for i, j, similarity in duplicates:
+        print(f"similarity {similarity:.2f}:")
+        for time, record in [records[i], records[j]]:
+            print(f"  {time}: {record}")
+        if args['interactive']:
             input("ENTER to continue")
 
-    print(f"found {count} duplicates")
-    # write_yaml(quotes, f"{src}.fixed")
+    print(f"found {len(duplicates)} duplicates")
+
+    if args['dst'] is not None:
+        if not args['remove_across_times']:
+            duplicates = [(i, j, similarity) for i, j, similarity in duplicates if records[i][0] == records[j][0]]
+        write_yaml(remove_duplicates(records, duplicates), args['dst'])
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+from common import minute_to_timestr
+
+INDEX_NAME = 'index.txt'
+
+
+def get_args():
+    parser = ArgumentParser(
+        prog='image_index',
+        description='Generate (or check) the per-minute index of an image folder which is used by timelit.sh.',
+    )
+    parser.add_argument('dst', help='image folder', type=Path)
+    parser.add_argument('--check', help='only check that the index matches the images on disk', action='store_true')
+
+    return vars(parser.parse_args())
+
+
+def build_index(dst: Path):
+    """map every minute of the day (HHMM) to the sorted names of its quote images"""
+    index = {minute_to_timestr(minute).replace(':', ''): [] for minute in range(24 * 60)}
+    for path in sorted(dst.glob('quote_*.png')):
+        time = path.name[6:10]  # quote_HHMM_<hash>.png
+        if time in index:
+            index[time].append(path.name)
+    return index
+
+
+def write_index(dst: Path, index=None):
+    """write the index with one line per minute: HHMM followed by the file names of its images"""
+    if index is None:
+        index = build_index(dst)
+    tmp = dst / f'{INDEX_NAME}.tmp'
+    with open(tmp, 'w', encoding='utf8', newline='\n') as index_file:
+        for time, names in index.items():
+            index_file.write(' '.join([time] + names) + '\n')
+    tmp.replace(dst / INDEX_NAME)
+
+
+def read_index(dst: Path):
+    index = {}
+    with open(dst / INDEX_NAME, encoding='utf8') as index_file:
+        for line in index_file:
+            time, *names = line.split()
+            index[time] = names
+    return index
+
+
+def check_index(dst: Path):
+    """compare the index with the images on disk - returns a list of problems"""
+    try:
+        index = read_index(dst)
+    except FileNotFoundError:
+        return [f"no {INDEX_NAME} in {dst}"]
+
+    problems = []
+    expected = build_index(dst)
+    for time, names in expected.items():
+        indexed = index.get(time)
+        if indexed is None:
+            problems.append(f"{time}: missing in index")
+            continue
+        for name in sorted(set(indexed) - set(names)):
+            problems.append(f"{time}: {name} is indexed but does not exist")
+        for name in sorted(set(names) - set(indexed)):
+            problems.append(f"{time}: {name} is not indexed")
+        for name in indexed:
+            credits = dst / 'metadata' / name.replace('.png', '_credits.png')
+            if not credits.exists():
+                problems.append(f"{time}: credits image {credits.name} does not exist")
+    for time in index.keys() - expected.keys():
+        problems.append(f"{time}: invalid time in index")
+    return problems
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args['check']:
+        problems = check_index(args['dst'])
+        for problem in problems:
+            print(problem)
+        if problems:
+            print(f"{len(problems)} problems found")
+            sys.exit(1)
+        print("index ok")
+    else:
+        write_index(args['dst'])
@@ -0,0 +1,48 @@
+import json
+from hashlib import sha1
+from pathlib import Path
+
+MANIFEST_NAME = '.manifest.json'
+
+
+def hash_file(path, chunk_size=1 << 20):
+    hsh = sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            hsh.update(chunk)
+    return hsh.hexdigest()
+
+
+def hash_settings(settings: dict):
+    return sha1(json.dumps(settings, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+class BuildManifest:
+    """
+    Record of the images in a destination folder together with the key of the settings they have been rendered with.
+
+    The image basenames already contain a hash of the quote data, so an image only has to be re-rendered if it is not
+    recorded or if the settings key has changed.
+    """
+    def __init__(self, dst: Path):
+        self.path = dst / MANIFEST_NAME
+        try:
+            with open(self.path, encoding='utf8') as manifest_file:
+                self.images = json.load(manifest_file)
+        except FileNotFoundError:
+            self.images = {}
+
+    def is_current(self, basename, key):
+        return self.images.get(basename) == key
+
+    def add(self, basename, key):
+        self.images[basename] = key
+
+    def remove(self, basename):
+        self.images.pop(basename, None)
+
+    def save(self):
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf8') as manifest_file:
+            json.dump(self.images, manifest_file, indent=0, sort_keys=True)
+        tmp.replace(self.path)
@@ -0,0 +1,91 @@
+import sqlite3
+from collections import OrderedDict
+from hashlib import sha1
+from pathlib import Path
+
+DEFAULT_MAXSIZE = 100000
+
+
+class MeasurementCache:
+    """
+    LRU cache of text extents (height, width) keyed by a description of the text with its fonts and font size (but not
+    its colors, which do not change the extents) and the layout width - optionally persisted in a sqlite file.
+
+    The key of the cache (e.g. a hash of the used font files) is stored with the measurements: a persisted cache with a
+    different key is discarded.
+    """
+    def __init__(self, path: Path = None, maxsize=DEFAULT_MAXSIZE, key=''):
+        self.path = path
+        self.maxsize = maxsize
+        self.key = key
+        self.entries = OrderedDict()  # least recently used first
+        self.used = set()  # entries used since loading (these are saved)
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self._load()
+
+    @staticmethod
+    def _get_key(text: str, width: int):
+        return sha1(f"{width}:{text}".encode('UTF-8')).digest()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60)  # the processes of a pool save at the same time
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS measurements "
+                           "(key BLOB PRIMARY KEY, height REAL, width REAL, generation INTEGER)")
+        return connection
+
+    def _load(self):
+        with self._connect() as connection:
+            meta = dict(connection.execute("SELECT key, value FROM meta"))
+            if meta.get('key', self.key) != self.key:
+                return  # measured with other fonts
+            rows = connection.execute("SELECT key, height, width FROM measurements ORDER BY generation DESC LIMIT ?",
+                                      (self.maxsize,)).fetchall()
+        connection.close()
+        for key, height, width in reversed(rows):
+            self.entries[key] = (height, width)
+
+    def get(self, text: str, width: int):
+        key = self._get_key(text, width)
+        extents = self.entries.get(key)
+        if extents is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        self.used.add(key)
+        return extents
+
+    def put(self, text: str, width: int, extents):
+        key = self._get_key(text, width)
+        self.entries[key] = extents
+        self.entries.move_to_end(key)
+        self.used.add(key)
+        if len(self.entries) > self.maxsize:
+            old_key, _ = self.entries.popitem(last=False)
+            self.used.discard(old_key)
+
+    def save(self):
+        """write the used measurements and drop the least recently used ones beyond maxsize"""
+        if self.path is None or not self.used:
+            return
+        with self._connect() as connection:
+            meta = dict(connection.execute("SELECT key, value FROM meta"))
+            if meta.get('key', self.key) != self.key:
+                connection.execute("DELETE FROM measurements")
+            generation = int(meta.get('generation', 0)) + 1
+            connection.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                   [('key', self.key), ('generation', str(generation))])
+            connection.executemany("INSERT OR REPLACE INTO measurements VALUES (?, ?, ?, ?)",
+                                   ((key, *self.entries[key], generation) for key in self.used
+                                    if key in self.entries))
+            connection.execute("DELETE FROM measurements WHERE key NOT IN "
+                               "(SELECT key FROM measurements ORDER BY generation DESC LIMIT ?)", (self.maxsize,))
+        connection.close()
+        self.used = set()
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
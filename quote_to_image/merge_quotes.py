@@ -1,9 +1,20 @@
 #!/usr/bin/env python
+import csv
 from argparse import ArgumentParser
+from collections import Counter
 from pathlib import Path
 import re
 
-from common import write_yaml, get_quotes, minute_to_timestr
+from common import write_yaml, get_quotes
+
+NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+METADATA_KEYS = ['timestring', 'author', 'title', 'chapter']  # differences in other keys are ignored
+
+CONFLICT_POLICIES = {
+    'keep': 'keep the existing quote',
+    'replace': 'replace the existing quote with the new one',
+    'both': 'keep both quotes',
+}
 
 
 def get_args():
@@ -11,43 +22,131 @@ def get_args():
         prog='merge_quotes',
         description='Merge Literature Clock quote files in yaml format.',
     )
-    parser.add_argument('src1', help='source yaml', type=Path)
-    parser.add_argument('src2', help='source yaml', type=Path)
+    parser.add_argument('src', help='source yaml files (quotes of later files are added to the earlier ones)',
+                        type=Path, nargs='+')
     parser.add_argument('dst', help="destination yaml", type=Path)
+    parser.add_argument('-conflicts', help='what to do with quotes which match the text of an existing quote of the '
+                                           'same time but differ in timestring, author, title or chapter: ' +
+                                           ', '.join(f"{k}: {v}" for k, v in CONFLICT_POLICIES.items()) +
+                                           ' (default=keep)',
+                        choices=CONFLICT_POLICIES.keys(), default='keep')
+    parser.add_argument('-time-conflicts', help='what to do with quotes which match the text of existing quotes of '
+                                                'other times only (e.g. a quote filed under every minute it names): '
+                                                'same choices as -conflicts, replace replaces all of them '
+                                                '(default=both)',
+                        choices=CONFLICT_POLICIES.keys(), default='both')
+    parser.add_argument('-report', help='write the origin and merge status of every quote to this csv file',
+                        type=Path, default=None)
 
-    args = parser.parse_args()
-
-    return args.src1, args.src2, args.dst
+    return vars(parser.parse_args())
 
 
 def normalize(s: str):
     # prepare quote for comparison
     # remove non-alphanumeric chars
-    pattern = re.compile('[\W_]+')
-    s = pattern.sub('', s)
+    s = NON_ALPHANUMERIC.sub('', s)
 
     # make lowercase
     return s.lower()
 
 
-def merge_quotes(qs1, qs2):
-    for minute in range(0, 60 * 24):
-        timestr = minute_to_timestr(minute)
-        for q2 in qs2.get(timestr, []):
-            text = normalize(q2['quote'])
-            # check if already present
-            for q1 in qs1.get(timestr, []):
-                if text == normalize(q1['quote']):
-                    break
-            else:
-                qs1.setdefault(timestr, []).append(q2)
+def get_key(record):
+    return normalize(record['quote'])
+
+
+def get_metadata(record):
+    return {key: str(value).strip() for key, value in record.items() if key in METADATA_KEYS}
+
+
+def is_same_metadata(a: dict, b: dict):
+    # keys present in only one of the records (e.g. chapter) do not make a difference
+    return all(a[key] == b[key] for key in a.keys() & b.keys())
+
+
+class QuoteMerger:
+    """Merge quote files using an index of the normalized quote texts."""
+    def __init__(self, conflict_policy='keep', time_conflict_policy='both'):
+        self.conflict_policy = conflict_policy
+        self.time_conflict_policy = time_conflict_policy
+        self.quotes = {}
+        self.index = {}  # normalized quote -> list of (time, record)
+        self.report = []  # (source, status, time, record)
+
+    def _add(self, time, record):
+        self.quotes.setdefault(time, []).append(record)
+        self.index.setdefault(get_key(record), []).append((time, record))
+
+    def _remove(self, time, record):
+        self.quotes[time] = [r for r in self.quotes[time] if r is not record]
+        if not self.quotes[time]:
+            del self.quotes[time]
+        entries = self.index[get_key(record)]
+        entries[:] = [(t, r) for t, r in entries if r is not record]
+
+    def add_base(self, source, quotes: dict):
+        """add all quotes of a file without checking for duplicates"""
+        for time, records in quotes.items():
+            for record in records:
+                self._add(time, record)
+                self.report.append((source, 'added', time, record))
+
+    def merge(self, source, quotes: dict):
+        merged = set()  # ids of the records of this source which were added
+        for time, records in quotes.items():
+            for record in records:
+                matches = self.index.get(get_key(record), [])
+                same_time = [(t, r) for t, r in matches if t == time]
+                # a source filing a quote under several times is not a conflict with itself
+                other_times = [(t, r) for t, r in matches if t != time and id(r) not in merged]
+                metadata = get_metadata(record)
+                if not same_time and not other_times:
+                    status = 'added'
+                    self._add(time, record)
+                elif not same_time:
+                    # the text is filed under other times only
+                    status = 'other time: ' + self._resolve(self.time_conflict_policy, other_times, time, record)
+                elif any(is_same_metadata(get_metadata(r), metadata) for _, r in same_time):
+                    status = 'duplicate'
+                else:
+                    status = 'conflict: ' + self._resolve(self.conflict_policy, same_time[:1], time, record)
+                if status.endswith(('added', 'replaced')):
+                    merged.add(id(record))
+                self.report.append((source, status, time, record))
+
+    def _resolve(self, policy, matches, time, record):
+        """apply a conflict policy to a record matching the given (time, record) entries - returns the status"""
+        if policy == 'keep':
+            return 'skipped'
+        if policy == 'replace':
+            for match in list(matches):
+                self._remove(*match)
+        self._add(time, record)
+        return 'replaced' if policy == 'replace' else 'added'
+
+    def write_report(self, path: Path):
+        with open(path, 'w', newline='', encoding='utf8') as report_file:
+            writer = csv.writer(report_file, delimiter='|')
+            writer.writerow(['source', 'status', 'time', 'timestring', 'author', 'title'])
+            for source, status, time, record in self.report:
+                writer.writerow([source, status, time, record.get('timestring'), record.get('author'),
+                                 record.get('title')])
 
 
 if __name__ == '__main__':
-    src1, src2, dst = get_args()
-    quotes = get_quotes(src1)
-    quotes2 = get_quotes(src2)
+    args = get_args()
+
+    merger = QuoteMerger(args['conflicts'], args['time_conflicts'])
+    for i, src in enumerate(args['src']):
+        quotes = get_quotes(src)
+        if i == 0:
+            merger.add_base(str(src), quotes)
+        else:
+            merger.merge(str(src), quotes)
 
-    merge_quotes(quotes, quotes2)
+    counts = Counter((source, status) for source, status, _, _ in merger.report)
+    for (source, status), count in counts.items():
+        print(f"{source}: {count} {status}")
 
-    write_yaml(quotes, dst)
+    write_yaml(merger.quotes, args['dst'])
+    if args['report'] is not None:
+        merger.write_report(args['report'])
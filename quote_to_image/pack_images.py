@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import shutil
+import sys
+from argparse import ArgumentParser
+from hashlib import sha1
+from pathlib import Path
+
+from image_index import INDEX_NAME, build_index, read_index
+
+PACK_MAGIC = 'LITPACK'
+PACK_VERSION = '1'
+NAME_LENGTH = 12  # characters of the quote hash which identify an image within its minute
+
+
+def get_args():
+    parser = ArgumentParser(
+        prog='pack_images',
+        description='Pack the quote and credits images of an image folder into a single file which is read by '
+                    'timelit.sh and eventloop.sh (see timelit/pack.sh).',
+    )
+    parser.add_argument('src', help='image folder', type=Path)
+    parser.add_argument('dst', help="destination file (default: <src>.pack)", type=Path, nargs='?')
+    parser.add_argument('--verify', help='compare the packed images with the image folder', action='store_true')
+
+    args = vars(parser.parse_args())
+    if args['dst'] is None:
+        args['dst'] = args['src'].with_name(args['src'].name + '.pack')
+    return args
+
+
+def get_name(file_name: str):
+    return file_name[11:11 + NAME_LENGTH]  # quote_HHMM_<hash>.png
+
+
+def pack_images(src: Path, dst: Path):
+    """
+    Write all images of src to one file: a text header with one line per minute followed by the image data.
+
+    The first line of the header is "LITPACK <version> <header length>", followed by lines
+    "HHMM <name>:<offset>:<length>:<credits offset>:<credits length> ..." (offsets relative to the end of the header)
+    and a final "END" line. Identical images are stored only once.
+    """
+    index = read_index(src) if (src / INDEX_NAME).exists() else build_index(src)
+
+    blobs = {}  # content hash -> (offset, length)
+    lines = []
+    data_file = dst.with_name(dst.name + '.data')
+    with open(data_file, 'wb') as data:
+        def add(path: Path):
+            content = path.read_bytes()
+            key = sha1(content).digest()
+            if key not in blobs:
+                blobs[key] = data.tell(), len(content)
+                data.write(content)
+            return blobs[key]
+
+        for time, names in index.items():
+            entries = []
+            for name in names:
+                quote = add(src / name)
+                credits = add(src / 'metadata' / name.replace('.png', '_credits.png'))
+                entries.append(f"{get_name(name)}:{quote[0]}:{quote[1]}:{credits[0]}:{credits[1]}")
+            lines.append(' '.join([time] + entries) + '\n')
+    lines.append('END\n')
+
+    body = ''.join(lines).encode('ascii')
+    first_line = f"{PACK_MAGIC} {PACK_VERSION} {{:010d}}\n"  # fixed length, so it can contain the header length
+    header = first_line.format(len(first_line.format(0)) + len(body)).encode('ascii') + body
+
+    tmp = dst.with_name(dst.name + '.tmp')
+    with open(tmp, 'wb') as pack, open(data_file, 'rb') as data:
+        pack.write(header)
+        shutil.copyfileobj(data, pack)
+    data_file.unlink()
+    tmp.replace(dst)
+    return sum(len(names) for names in index.values()), len(blobs)
+
+
+def read_pack(path: Path):
+    """read the header of a pack - returns a dict of time -> list of (name, quote (offset, length), credits)"""
+    pack = {}
+    with open(path, 'rb') as pack_file:
+        magic, version, header_length = pack_file.readline().decode('ascii').split()
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise Exception(f"{path} is not a pack of version {PACK_VERSION}")
+        for line in pack_file:
+            time, *entries = line.decode('ascii').split()
+            if time == 'END':
+                break
+            pack[time] = []
+            for entry in entries:
+                name, *numbers = entry.split(':')
+                offsets = [int(n) + int(header_length) if i % 2 == 0 else int(n) for i, n in enumerate(numbers)]
+                pack[time].append((name, tuple(offsets[:2]), tuple(offsets[2:])))
+    return pack
+
+
+def verify_pack(src: Path, path: Path):
+    """compare a pack with the images it has been created from - returns a list of problems"""
+    problems = []
+    index = build_index(src)
+    pack = read_pack(path)
+    with open(path, 'rb') as pack_file:
+        def read(offset, length):
+            pack_file.seek(offset)
+            return pack_file.read(length)
+
+        for time, names in index.items():
+            entries = {name: (quote, credits) for name, quote, credits in pack.get(time, [])}
+            for name in names:
+                if get_name(name) not in entries:
+                    problems.append(f"{time}: {name} is not packed")
+                    continue
+                quote, credits = entries[get_name(name)]
+                if read(*quote) != (src / name).read_bytes():
+                    problems.append(f"{time}: {name} differs")
+                if read(*credits) != (src / 'metadata' / name.replace('.png', '_credits.png')).read_bytes():
+                    problems.append(f"{time}: credits of {name} differ")
+            if len(entries) != len(names):
+                problems.append(f"{time}: {len(entries)} images packed, {len(names)} expected")
+    return problems
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args['verify']:
+        problems = verify_pack(args['src'], args['dst'])
+        for problem in problems:
+            print(problem)
+        if problems:
+            print(f"{len(problems)} problems found")
+            sys.exit(1)
+        print("pack ok")
+    else:
+        images, blobs = pack_images(args['src'], args['dst'])
+        print(f"packed {images} quotes ({blobs} distinct images) into {args['dst']}")
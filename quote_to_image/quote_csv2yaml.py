@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 from argparse import ArgumentParser
-from collections import defaultdict
-from csv import DictReader
+from csv import reader
 from pathlib import Path
 import sys
 
-from common import write_yaml
+from common import COMPILED_SUFFIX, CompiledCorpus, dump_quotes
+
+CHUNK_MINUTES = 60  # number of minutes which are written to the yaml at once
 
 
 def get_args():
@@ -13,8 +14,9 @@ def get_args():
         prog='quote_csv2yaml',
         description='Convert Literature Clock quotes from csv to yaml format.',
     )
-    parser.add_argument('src', help='source csv', type=Path)
-    parser.add_argument('dst', help="destination yaml (if omitted the source's .csv ending will be replaced with .yaml)",
+    parser.add_argument('src', help='source csv (rows with the same time have to be consecutive)', type=Path)
+    parser.add_argument('dst', help="destination yaml (if omitted the source's .csv ending will be replaced with "
+                                    f".yaml) - with a {COMPILED_SUFFIX} ending the compiled corpus format is written",
                         nargs='?', type=Path)
 
     args = parser.parse_args()
@@ -27,34 +29,61 @@ def get_args():
     return args.src, args.dst
 
 
-def read_csv(src_file):
-    with open(src_file, newline='\n', encoding="utf8") as csvfile:
-        reader = DictReader(csvfile, delimiter='|')
-        result = list(reader)
-    result_num = len(result)
+def iter_csv(src_file, errors: list):
+    """
+    Read the csv row by row - yields (time, records) for each block of rows with the same time.
 
-    # count lines of csv
-    with open(src_file, "rb") as f:
-        csv_num = sum(1 for _ in f) - 1
+    Malformed rows (wrong number of fields, e.g. due to a '|' in the quote, or spanning several lines due to a '"') are
+    reported and added to errors.
+    """
+    with open(src_file, newline='\n', encoding="utf8") as csvfile:
+        csv_reader = reader(csvfile, delimiter='|')
+        header = next(csv_reader)
+        time, records, finished = None, [], set()
+        line = csv_reader.line_num
+        for row in csv_reader:
+            start, line = line + 1, csv_reader.line_num
+            if line != start or len(row) != len(header):
+                lines = f"{start}-{line}" if line != start else f"{start}"
+                error = (f"line {lines}: malformed row ({len(row)} fields, expected {len(header)}): "
+                         f"{'|'.join(row)[:80]!r}")
+                print(error, file=sys.stderr, flush=True)
+                errors.append(error)
+                continue
 
-    if result_num != csv_num:
-        suspicious = []
-        for record in result:
-            if len(record['quote']) > 700 or '|' in record['quote']:
-                suspicious.append(record)
-        raise Exception(f"Parsed result has {result_num} records - expected {csv_num}. Suspicious: {suspicious}")
+            record = dict(zip(header, row))
+            row_time = record.pop('time')
+            if row_time != time:
+                if time is not None:
+                    yield time, records
+                    finished.add(time)
+                if row_time in finished:
+                    raise Exception(f"line {start}: rows are not grouped by time ({row_time} after {time})")
+                time, records = row_time, []
+            records.append(record)
 
-    return result
+        if time is not None:
+            yield time, records
 
 
 if __name__ == '__main__':
     src, dst = get_args()
-    quotes = read_csv(src)
 
-    # transform from simple list of dicts to a dict with time as primary key and a list of quotes as elements
-    quotes_dict = defaultdict(lambda: [])
-    for quote in quotes:
-        time = quote.pop('time')
-        quotes_dict[time].append(quote)
+    errors = []
+    minutes = iter_csv(src, errors)
+    if dst.suffix == COMPILED_SUFFIX:
+        CompiledCorpus.create(dst, minutes).close()
+    else:
+        with open(dst, 'w') as yaml_file:
+            chunk = {}
+            for time, records in minutes:
+                chunk[time] = records
+                if len(chunk) >= CHUNK_MINUTES:
+                    dump_quotes(chunk, yaml_file)
+                    chunk = {}
+            if chunk or yaml_file.tell() == 0:  # (an empty mapping for an empty csv)
+                dump_quotes(chunk, yaml_file)
 
-    write_yaml(dict(quotes_dict), dst)
+    if errors:
+        print(f"{len(errors)} malformed rows skipped")
+        sys.exit(1)
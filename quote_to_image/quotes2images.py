@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 import html
+import json
+import os
 import re
+import shutil
+import subprocess
+import sys
 from argparse import ArgumentParser
-from dataclasses import dataclass, fields, replace
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, fields, replace
 from hashlib import sha1
+from math import ceil, floor, sqrt
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from statistics import median
+from time import perf_counter
 
 from sortedcontainers import SortedDict
 from pathlib import Path
@@ -13,12 +24,14 @@ import pangocairocffi
 from pangocffi import units_from_double, units_to_double
 from PIL import Image
 
-from common import get_quotes, minute_to_timestr, timestr_to_minute
+from common import ANNOTATION_MARGIN, AREA_PER_CHAR, DEFAULT_MARGIN, FONT_SIZE_MAX, FONT_SIZE_MIN, Corpus, \
+    get_source_info, minute_to_timestr, timestr_to_minute, write_yaml
+from image_index import write_index
+from manifest import BuildManifest, hash_file, hash_settings
+from measure_cache import DEFAULT_MAXSIZE, MeasurementCache
+from shards import CHECKPOINT_NAME, STAGING_NAME, ShardCheckpoint, get_shards, merge_staging
 
-DEFAULT_MARGIN = 26
-ANNOTATION_MARGIN = 100
-FONT_SIZE_MIN = 19
-FONT_SIZE_MAX = None
+CREDITS_CACHE_SIZE = 32  # MiB
 
 
 @dataclass(kw_only=True, frozen=False)
@@ -49,6 +62,33 @@ STYLES = {
 }
 
 
+@dataclass(kw_only=True, frozen=True)
+class DeviceProfile:
+    width: int
+    height: int
+    margin: int
+    meta_margin: int
+    meta_size: float = None  # None: size of the color theme
+    gray_depth: int
+
+
+# margins and metadata size scaled with the width of the 600x800 layout
+DEVICE_PROFILES = {
+    'kindle': DeviceProfile(  # Kindle 4, 5, Touch, 7
+        width=600, height=800, margin=26, meta_margin=100, meta_size=18, gray_depth=4
+    ),
+    'paperwhite': DeviceProfile(  # Kindle Paperwhite 1, 2
+        width=758, height=1024, margin=33, meta_margin=126, meta_size=23, gray_depth=4
+    ),
+    'paperwhite3': DeviceProfile(  # Kindle Paperwhite 3, 4, Voyage, Oasis 1
+        width=1072, height=1448, margin=46, meta_margin=179, meta_size=32, gray_depth=4
+    ),
+    'oasis': DeviceProfile(  # Kindle Oasis 2, 3
+        width=1264, height=1680, margin=55, meta_margin=211, meta_size=38, gray_depth=4
+    ),
+}
+
+
 def get_arguments():
     parser = ArgumentParser(
         prog='quotes2images',
@@ -58,6 +98,9 @@ def get_arguments():
     parser.add_argument('dst', help='destination folder', type=Path)
     parser.add_argument('-style', help=f'font and background style (one of: {list(STYLES.keys())}, default=default)',
                         type=str, default='default')
+    parser.add_argument('-styles', help='render several styles at once (comma separated, e.g. default,dark): the first '
+                                        'style is written to dst, the second to <dst>_other, further ones to '
+                                        '<dst>_other2, ... (overrides -style)', type=str, default=None)
 
     parser.add_argument('-text_font', help='override font for regular text', type=str, default=None)
     parser.add_argument('-text_color', help='override color for regular text', type=str, default=None)
@@ -74,22 +117,76 @@ def get_arguments():
     parser.add_argument('-margin', help='margin around text in pixels', type=int, default=DEFAULT_MARGIN)
     parser.add_argument('-no-convert-grayscale', help='do *not* convert the resulting image to grayscale',
                         action='store_false', dest='grayscale')
+    parser.add_argument('-gray-depth', help='bits per pixel of grayscale images (4: 16 gray levels like the e-ink '
+                                            'display, written as palette png, default=8)',
+                        type=int, choices=[8, 4], default=8)
+    parser.add_argument('-dither', help='dither images with reduced gray depth', action='store_true')
+    parser.add_argument('-profiles', help='render for several devices at once (comma separated, one of: '
+                                          f'{list(DEVICE_PROFILES.keys())}) into dst/<profile> - overrides width, '
+                                          'height, margin and gray depth', type=str, default=None)
     parser.add_argument('--statistics', help='collect and show statistics', action='store_true')
+    parser.add_argument('-report', help='write per-quote timings and font size search details to this file '
+                                        '(json lines)', type=Path, default=None)
+    parser.add_argument('-jobs', help='number of parallel render processes (0: one per CPU, default=1)',
+                        type=int, default=1)
+    parser.add_argument('-measure-cache', help='keep the measured text extents in this file to reuse them in later '
+                                               'runs', type=Path, default=None)
+    parser.add_argument('-measure-cache-size', help='maximum number of cached measurements '
+                                                    f'(default={DEFAULT_MAXSIZE})', type=int, default=DEFAULT_MAXSIZE)
+    parser.add_argument('-shard-minutes', help='render in shards of this many minutes: finished shards are recorded in '
+                                               f'dst/{CHECKPOINT_NAME} and skipped when the run is restarted, quotes '
+                                               'which cannot be rendered are written to dst/quarantine.yaml instead '
+                                               'of stopping the run (default=0: no shards)', type=int, default=0)
+    parser.add_argument('-credits-cache-size', help='memory for rendered credits per process in MiB, which are reused '
+                                                    f'for quotes of the same title and author (default='
+                                                    f'{CREDITS_CACHE_SIZE}, 0: no cache)',
+                        type=int, default=CREDITS_CACHE_SIZE)
+    parser.add_argument('-incremental', help='only render new or changed quotes and delete images of removed quotes',
+                        action='store_true')
 
     parser.add_argument('-start-time', help='optional time to start', type=str, default="00:00")
     parser.add_argument('-stop-time', help='optional time to stop', type=str, default="23:59")
 
     parsed = vars(parser.parse_args())
-    parsed['color_theme'] = STYLES[parsed['style']]
-    for field in fields(ColorTheme):
-        if parsed[field.name] is not None:
-            parsed['color_theme'] = replace(parsed['color_theme'], **{field.name: parsed[field.name]})
+    styles = parsed['style'] if parsed['styles'] is None else parsed['styles']
+    parsed['color_themes'] = []
+    for style in styles.split(','):
+        if style not in STYLES:
+            raise RuntimeError(f"unknown style {style} (one of: {list(STYLES.keys())})")
+        color_theme = STYLES[style]
+        for field in fields(ColorTheme):
+            if parsed[field.name] is not None:
+                color_theme = replace(color_theme, **{field.name: parsed[field.name]})
+        parsed['color_themes'].append(color_theme)
+
+    if parsed['profiles'] is None:
+        parsed['profiles'] = [(None, DeviceProfile(width=parsed['width'], height=parsed['height'],
+                                                   margin=parsed['margin'], meta_margin=ANNOTATION_MARGIN,
+                                                   gray_depth=parsed['gray_depth']))]
+    else:
+        profiles = []
+        for name in parsed['profiles'].split(','):
+            if name not in DEVICE_PROFILES:
+                raise RuntimeError(f"unknown profile {name} (one of: {list(DEVICE_PROFILES.keys())})")
+            profile = DEVICE_PROFILES[name]
+            if parsed['meta_size'] is not None:
+                profile = replace(profile, meta_size=None)  # keep the overridden size
+            profiles.append((name, profile))
+        parsed['profiles'] = profiles
 
     for t in ['start_time', 'stop_time']:
         parsed[t] = timestr_to_minute(parsed[t])
     if parsed['start_time'] > parsed['stop_time']:
         raise RuntimeError("start-time may not be later than stop-time")
 
+    if parsed['shard_minutes'] < 0:
+        raise RuntimeError("shard-minutes may not be negative")
+
+    if parsed['jobs'] < 0:
+        raise RuntimeError("jobs may not be negative")
+    if parsed['jobs'] == 0:
+        parsed['jobs'] = os.cpu_count() or 1
+
     return parsed
 
 
@@ -97,14 +194,53 @@ class Quote2ImageException(Exception):
     pass
 
 
+class CreditsCache:
+    """LRU cache of rendered credits (transparent surfaces) limited by the memory of the surfaces."""
+    def __init__(self, max_bytes=CREDITS_CACHE_SIZE << 20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()  # key -> (surface, x, y), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        size = self._get_size(entry)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, old_entry = self.entries.popitem(last=False)
+            self.bytes -= self._get_size(old_entry)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= self._get_size(entry)
+
+    @staticmethod
+    def _get_size(entry):
+        surface = entry[0]
+        return surface.get_stride() * surface.get_height()
+
+
 class Quote2Image:
     FONT_SIZE_PRECISION = 0.5  # precision of font size search
-    FONT_SIZE_START = 40
-    FONT_SIZE_STEPS = 3  # determines the initial step size of the search algorithm
-    MAX_STEP = FONT_SIZE_PRECISION * 2 ** FONT_SIZE_STEPS
+    AREA_PER_CHAR = AREA_PER_CHAR  # initial prediction, updated with the median of the recently solved quotes
+    AREA_PER_CHAR_SAMPLES = 101  # number of solved quotes in the running median
 
     def __init__(self, width: int, height: int, color_theme: ColorTheme,
-                 margin=DEFAULT_MARGIN, meta_margin=ANNOTATION_MARGIN, meta_width_ratio=0.7):
+                 margin=DEFAULT_MARGIN, meta_margin=ANNOTATION_MARGIN, meta_width_ratio=0.7,
+                 measure_cache: MeasurementCache = None, measure_only=False, credits_cache: CreditsCache = None):
         self.width = width
         self.height = height
 
@@ -113,131 +249,247 @@ class Quote2Image:
         self.margin = margin
         self.meta_margin = meta_margin
         self.meta_width_ratio = meta_width_ratio
+        self.measure_cache = measure_cache
+        self.measure_only = measure_only  # only measure text (see fits), nothing can be rendered
+        self.credits_cache = credits_cache
 
-        self.layout = None
+        # created on first use and reused for all quotes
         self.surface = None
+        self.context = None
+        self.layout = None
+        self.meta_layout = None
 
         self.iterations = {}
+        self.layout_calls = 0
+        self.cache_hits = 0
         self.quote_len = None
+        self.area_per_char = None
+        self.solved_area_per_char = deque(maxlen=self.AREA_PER_CHAR_SAMPLES)
+        self.text = None
         self.quote = None
         self.timestr = None
         self.font_size = None
 
+    def _create_surface(self):
+        # the layouts only need a context, the text is not drawn when measuring only
+        surface_size = (1, 1) if self.measure_only else (self.width, self.height)
+        self.surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32, *surface_size)
+        self.context = cairocffi.Context(self.surface)
+
+        self.layout = pangocairocffi.create_layout(self.context)
+        self.layout.wrap = pangocffi.WrapMode.WORD
+        self.layout.width = units_from_double(self.width - 2 * self.margin)
+
+        self.meta_layout = pangocairocffi.create_layout(self.context)
+        self.meta_layout.wrap = pangocffi.WrapMode.WORD
+        self.meta_layout.width = units_from_double(self.width * self.meta_width_ratio)
+        self.meta_layout.alignment = pangocffi.Alignment.RIGHT
+
     def add_quote(self, quote: str, timestr: str):
+        self._prepare_quote(quote, timestr)
+        self._find_font_size()
+        self._render_quote()
+
+    def _prepare_quote(self, quote: str, timestr: str):
         self.quote = quote
         self.timestr = timestr
         self.iterations = {}
-        self.surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32, self.width, self.height)
+        self.layout_calls = 0
+        self.cache_hits = 0
+        if self.surface is None:
+            self._create_surface()
 
-        context = cairocffi.Context(self.surface)
-        # fill background
-        with context:
-            context.set_source_rgb(*self.color_theme.background)
-            context.paint()
+        self.text = re.sub("<br\\s*(/)?>", '\n', quote)
+        self.quote_len = len(quote)
+        self._apply_time_markup()
 
-        self.layout = pangocairocffi.create_layout(context)
-        self.layout.wrap = pangocffi.WrapMode.WORD
-        self.layout.width = units_from_double(self.width - 2 * self.margin)
+    def _apply_time_markup(self):
+        time_markup = (f"<span foreground='{self.color_theme.time_color}' "
+                       f"font_desc='{self.color_theme.time_font}'>{self.timestr}</span>")
+        self.quote = self.text.replace(self.timestr, time_markup, 1)
 
-        self.quote = re.sub("<br\\s*(/)?>", '\n', self.quote)
-        self.quote_len = len(quote)
-        self.quote = self.quote.replace(timestr, f"<span foreground='{self.color_theme.time_color}' "
-                                                 f"font_desc='{self.color_theme.time_font}'>{timestr}</span>", 1)
+    @staticmethod
+    def get_layout_key(color_theme: ColorTheme):
+        # the fonts of a theme determine the layout of the quote, the colors do not
+        return color_theme.text_font, color_theme.time_font
 
-        self._find_font_size()
-        self.layout.apply_markup(self._get_markup(self.quote, self.font_size))
+    def has_same_layout(self, color_theme: ColorTheme):
+        """whether the text layout with the given theme is the same as with the current one (only colors differ)"""
+        return self.get_layout_key(color_theme) == self.get_layout_key(self.color_theme)
 
-        context.move_to(self.margin, self.margin)
-        pangocairocffi.show_layout(context, self.layout)
+    def set_color_theme(self, color_theme: ColorTheme):
+        """switch the theme of the current quote - the font size stays valid if the layout is the same"""
+        self.color_theme = color_theme
+        if self.text is not None:
+            self._apply_time_markup()
 
-    def _check_font_size(self, font_size, max_height, max_width):
-        height, width = self._get_extents(font_size)
-        return height <= max_height and width <= max_width
+    def _render_quote(self):
+        # fill background (this also clears the previous quote)
+        with self.context:
+            self.context.set_source_rgb(*self.color_theme.background)
+            self.context.paint()
 
-    def _find_font_size(self):
-        max_height = self.height - self.margin - self.meta_margin
-        max_width = self.width - 2 * self.margin
-
-        # the initial guess decides if we iterate upwards or downwards
-        font_size = self._predict_font_size()
-        font_size_ok = self.iterations.setdefault(
-            font_size, self._check_font_size(font_size, max_height, max_width))
-
-        step = self.MAX_STEP * 1 if font_size_ok else -1
-        best = font_size if font_size_ok else None
-
-        while abs(step) >= self.FONT_SIZE_PRECISION:
-            font_size += step
-            while True:
-                font_size_ok = self.iterations.setdefault(
-                    font_size, self._check_font_size(font_size, max_height, max_width))
-                if not font_size_ok:
-                    if step > 0:
-                        break
-                else:
-                    best = font_size
-                    if step < 0:
-                        break
-                font_size += step
-
-            # overstepped
-            font_size -= step
-            step /= 2
-
-        if best is None:
+        self.layout.apply_markup(self._get_markup(self.quote, self.font_size))
+
+        self.context.move_to(self.margin, self.margin)
+        pangocairocffi.show_layout(self.context, self.layout)
+
+    def _get_text_area(self):
+        return self.height - self.margin - self.meta_margin, self.width - 2 * self.margin
+
+    def _find_font_size(self, font_size_hint=None):
+        max_height, max_width = self._get_text_area()
+        precision = self.FONT_SIZE_PRECISION
+
+        fits, too_large = None, None  # largest font size known to fit, smallest font size known not to fit
+        font_size = self._predict_font_size() if font_size_hint is None else font_size_hint
+        font_size = max(floor(font_size / precision) * precision, precision)
+        step = precision  # step of the search while the predictions stall (doubled with every such pass)
+        while True:
+            height, width = self._get_extents(font_size)
+            font_size_ok = self.iterations[font_size] = height <= max_height and width <= max_width
+            if font_size_ok:
+                fits = font_size
+            else:
+                too_large = font_size
+
+            if too_large is not None and too_large - (fits or 0) <= precision:
+                break  # found the largest font size (or none at all)
+            if FONT_SIZE_MIN and too_large is not None and too_large <= FONT_SIZE_MIN:
+                break
+            if FONT_SIZE_MAX and fits is not None and fits > FONT_SIZE_MAX:
+                break
+
+            # the lines keep their breaks until the widest line reaches the width, so a font size which fits can grow
+            # linearly until then - shrinking a font size which is too large removes lines, the height scales with the
+            # square of the font size
+            if not height or not width:
+                scale = 2
+            elif font_size_ok:
+                scale = min(max_height / height, max_width / width)
+            else:
+                scale = sqrt(max_height / height)
+                if width > max_width:
+                    scale = min(scale, max_width / width)  # a word is wider than a line
+            next_size = floor(font_size * scale / precision) * precision
+            if fits is not None and next_size <= fits:
+                next_size = fits + step  # the prediction stalls: gallop (the next pass verifies the font size)
+                step *= 2
+            elif too_large is not None and next_size >= too_large:
+                next_size = too_large - step
+                step *= 2
+            else:
+                step = precision
+            if fits is not None and too_large is not None:
+                next_size = min(max(next_size, fits + precision), too_large - precision)
+            font_size = max(next_size, precision)
+
+        if fits is None and not FONT_SIZE_MIN:
             raise Quote2ImageException(f"Could not find font_size for {self.quote}")
 
-        if FONT_SIZE_MIN and best < FONT_SIZE_MIN:
-            raise Quote2ImageException(f"font size {best} too small for {self.quote}")
+        if FONT_SIZE_MIN and (fits is None or fits < FONT_SIZE_MIN):
+            raise Quote2ImageException(f"font size too small for {self.quote} (minimum: {FONT_SIZE_MIN})")
+
+        if FONT_SIZE_MAX and fits > FONT_SIZE_MAX:
+            raise Quote2ImageException(f"font size {fits} too large for {self.quote}")
 
-        if FONT_SIZE_MAX and best > FONT_SIZE_MAX:
-            raise Quote2ImageException(f"font size {best} too large for {self.quote}")
+        self.font_size = fits
+        self.area_per_char = max_height * max_width / (max(self.quote_len, 1) * fits ** 2)
+        self.solved_area_per_char.append(self.area_per_char)
 
-        self.font_size = best
+    def fits(self, quote: str, timestr: str, font_size=FONT_SIZE_MIN):
+        """whether the quote fits into the text area at the given font size (a single layout pass)"""
+        self._prepare_quote(quote, timestr)
+        max_height, max_width = self._get_text_area()
+        height, width = self._get_extents(font_size)
+        return height <= max_height and width <= max_width
 
     def _predict_font_size(self):
-        if self.width == 600 and self.height == 800:
-            if self.quote_len < 50:
-                return 70
-            if self.quote_len < 100:
-                return 50
-            if self.quote_len < 200:
-                return 40
-            if self.quote_len < 400:
-                return 30
-            if self.quote_len < 600:
-                return 25
-            return 20
-        return self.FONT_SIZE_START
+        # assume that the text covers the whole text area
+        max_height, max_width = self._get_text_area()
+        area_per_char = median(self.solved_area_per_char) if self.solved_area_per_char else self.AREA_PER_CHAR
+        return sqrt(max_height * max_width / (area_per_char * max(self.quote_len, 1)))
+
+    def get_font_size_hint(self, other: 'Quote2Image'):
+        """starting point of the font size search: the font size solved by another Quote2Image (for the same quote at
+        a different resolution) scaled to the text area of this one"""
+        max_height, max_width = self._get_text_area()
+        other_height, other_width = other._get_text_area()
+        return other.font_size * sqrt(max_height * max_width / (other_height * other_width))
 
     def _get_extents(self, font_size):
+        measure_key = self._get_measure_key(font_size)
+        if self.measure_cache is not None:
+            extents = self.measure_cache.get(measure_key, self.layout.width)
+            if extents is not None:
+                self.cache_hits += 1
+                return extents
+
+        self.layout_calls += 1
         self.layout.apply_markup(self._get_markup(self.quote, font_size))
         _, ext = self.layout.get_extents()
-        return units_to_double(ext.height), units_to_double(ext.width)
+        extents = units_to_double(ext.height), units_to_double(ext.width)
+        if self.measure_cache is not None:
+            self.measure_cache.put(measure_key, self.layout.width, extents)
+        return extents
+
+    def _get_measure_key(self, font_size):
+        # everything the extents depend on: the fonts, the font size and the text (but not the colors)
+        return f"{self.color_theme.text_font} {font_size}\n{self.color_theme.time_font}\n{self.timestr}\n{self.text}"
 
     def _get_markup(self, quote, font_size):
         return (f"<span foreground='{self.color_theme.text_color}' font_desc='{self.color_theme.text_font} "
                 f"{font_size}'>{quote}</span>")
 
     def add_annotations(self, title, author):
+        pos_x = self.width * (1 - self.meta_width_ratio) - self.margin
+        if self.credits_cache is None:
+            height = self._apply_credits_markup(title, author)
+            self.context.move_to(pos_x, self.height - self.margin - height)
+            pangocairocffi.show_layout(self.context, self.meta_layout)
+            return
+
+        # the credits are rendered at the sub-pixel position they would be drawn at and painted at whole pixels, so
+        # the image is identical to drawing them directly (the position is part of the key)
+        theme = self.color_theme
+        key = (title, author, theme.meta_font, theme.meta_color, theme.meta_size, self.meta_layout.width,
+               pos_x, self.height - self.margin)
+        credits = self.credits_cache.get(key)
+        if credits is None:
+            credits = self._render_credits(title, author, pos_x)
+            self.credits_cache.put(key, credits)
+
+        surface, x, y = credits
+        with self.context:
+            self.context.set_source_surface(surface, x, y)
+            self.context.paint()
+
+    def _apply_credits_markup(self, title, author):
+        """prepare the layout of the credits - returns their height"""
         title = html.escape(title)
         author = html.escape(author)
 
-        context = cairocffi.Context(self.surface)
-
-        layout = pangocairocffi.create_layout(context)
-        layout.wrap = pangocffi.WrapMode.WORD
-        layout.width = units_from_double(self.width * self.meta_width_ratio)
-        layout.alignment = pangocffi.Alignment.RIGHT
-
-        layout.apply_markup(f'<span foreground="{self.color_theme.meta_color}" font_desc="{self.color_theme.meta_font} '
-                            f'{self.color_theme.meta_size}">—{title}, {author}</span>')
-        _, ext = layout.get_extents()
-
-        pos_x = self.width * (1 - self.meta_width_ratio) - self.margin
-        pos_y = self.height - self.margin - units_to_double(ext.height)
-        context.move_to(pos_x, pos_y)
-        pangocairocffi.show_layout(context, layout)
+        self.meta_layout.apply_markup(f'<span foreground="{self.color_theme.meta_color}" '
+                                      f'font_desc="{self.color_theme.meta_font} {self.color_theme.meta_size}">'
+                                      f'—{title}, {author}</span>')
+        _, ext = self.meta_layout.get_extents()
+        return units_to_double(ext.height)
+
+    def _render_credits(self, title, author, pos_x):
+        """render the credits to a transparent surface - returns (surface, x, y) with the whole pixel position of the
+        surface in the image"""
+        height = self._apply_credits_markup(title, author)
+        pos_y = self.height - self.margin - height
+        padding = ceil(self.color_theme.meta_size)  # for glyphs extending beyond the logical extents (e.g. italics)
+        x, y = floor(pos_x) - padding, floor(pos_y) - padding
+        surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32,
+                                         ceil(pos_x - x + units_to_double(self.meta_layout.width)) + padding,
+                                         ceil(pos_y - y + height) + padding)
+        context = cairocffi.Context(surface)
+        context.move_to(pos_x - x, pos_y - y)
+        pangocairocffi.show_layout(context, self.meta_layout)
+        surface.flush()
+        return surface, x, y
 
 
 class Statistics:
@@ -245,20 +497,26 @@ class Statistics:
         self.iterations = 0
         self.statistics = []
 
-    def add(self, q2i: Quote2Image, name):
-        iter_count = len(q2i.iterations)
-        self.statistics.append({
+    @staticmethod
+    def get_record(q2i: Quote2Image, name):
+        return {
             'name': name,
             'timestr': q2i.timestr,
             'quote_start': f"{q2i.quote[0:15]}...",
             'quote_len': q2i.quote_len,
             'font_size': q2i.font_size,
-            'iteration_count': count,
+            'iteration_count': len(q2i.iterations),
             'iterations': q2i.iterations,
-        })
-        self.iterations += iter_count
+            'layout_calls': q2i.layout_calls,
+            'cache_hits': q2i.cache_hits,
+            'area_per_char': q2i.area_per_char,
+        }
 
-    def __del__(self):
+    def add(self, record):
+        self.statistics.append(record)
+        self.iterations += record['iteration_count']
+
+    def print_report(self):
         sort_key = 'font_size'
         print(f"statistics sorted by {sort_key}:")
         self.statistics = sorted(self.statistics, key=lambda x: x[sort_key])
@@ -279,62 +537,425 @@ class Statistics:
         print(f"  iterations: {self.iterations}")
         if quotes > 0:
             print(f"  iterations per quote: {self.iterations / quotes}")
+            area_per_char = median(record['area_per_char'] for record in self.statistics)
+            print(f"  area per char (initial Quote2Image.AREA_PER_CHAR): {area_per_char:.3f}")
+            cache_hits = sum(record['cache_hits'] for record in self.statistics)
+            layout_calls = sum(record['layout_calls'] for record in self.statistics)
+            print(f"  measurement cache hits: {cache_hits} ({cache_hits / (cache_hits + layout_calls):.0%})")
+            credits_hits = sum(record['credits_cache_hits'] for record in self.statistics)
+            credits_rendered = sum(record['credits_rendered'] for record in self.statistics)
+            print(f"  credits cache hits: {credits_hits} ({credits_hits / credits_rendered:.0%})")
+
+    def get_summary(self, top=10):
+        def short(record):
+            return {key: record[key] for key in ['name', 'timestr', 'quote_len', 'font_size', 'layout_calls',
+                                                 'total_time']}
 
-
-def rgb2gray(file):
-    img_rgb = Image.open(file)
-    img_gray = img_rgb.convert('L')
-    img_gray.save(file)
+        quotes = len(self.statistics)
+        layout_calls = sum(record['layout_calls'] for record in self.statistics)
+        return {
+            'quotes': quotes,
+            'total_time': sum(record['total_time'] for record in self.statistics),
+            'bytes_written': sum(record['bytes_written'] for record in self.statistics),
+            'layout_calls_per_quote': layout_calls / quotes if quotes else 0,
+            'cache_hits_per_quote': sum(record['cache_hits'] for record in self.statistics) / quotes if quotes else 0,
+            'credits_cache_hits': sum(record['credits_cache_hits'] for record in self.statistics),
+            'slowest': [short(r) for r in sorted(self.statistics, key=lambda r: r['total_time'], reverse=True)[:top]],
+            'worst_search_paths': [
+                short(r) | {'iterations': r['iterations']}
+                for r in sorted(self.statistics, key=lambda r: r['layout_calls'], reverse=True)[:top]
+            ],
+        }
+
+    def write_report(self, path: Path):
+        """write one json record per quote followed by a summary record"""
+        with open(path, 'w', encoding='utf8') as report_file:
+            for record in self.statistics:
+                # json requires string keys - keep the order in which the font sizes have been tried
+                search_path = [[font_size, ok] for font_size, ok in record['iterations'].items()]
+                report_file.write(json.dumps({'type': 'quote'} | record | {'iterations': search_path}) + '\n')
+            summary = self.get_summary()
+            for r in summary['worst_search_paths']:
+                r['iterations'] = [[font_size, ok] for font_size, ok in r['iterations'].items()]
+            report_file.write(json.dumps({'type': 'summary'} | summary) + '\n')
+
+
+def get_gray_palette(gray_depth):
+    levels = 2 ** gray_depth
+    palette = Image.new('P', (1, 1))
+    palette.putpalette([v for i in range(levels) for v in (i * 255 // (levels - 1),) * 3])
+    return palette
+
+
+GRAY_PALETTE_4BIT = get_gray_palette(4)
+
+
+def surface_to_image(surface: cairocffi.ImageSurface, grayscale=True, gray_depth=8, dither=False):
+    """convert an ARGB32 surface to a grayscale (or RGB) image - the result is a copy of the surface content"""
+    surface.flush()
+    raw_mode = 'BGRA' if sys.byteorder == 'little' else 'ARGB'  # cairo uses native-endian 32 bit pixels
+    img_rgb = Image.frombuffer('RGBA', (surface.get_width(), surface.get_height()), surface.get_data(),
+                               'raw', raw_mode, surface.get_stride(), 1)
+    if not grayscale:
+        return img_rgb.convert('RGB')
+    if gray_depth == 8:
+        return img_rgb.convert('L')
+
+    # map to evenly spaced gray levels (note: pillow only quantizes RGB images to a given palette)
+    img_gray = img_rgb.convert('L').convert('RGB')
+    return img_gray.quantize(palette=GRAY_PALETTE_4BIT,
+                             dither=Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE)
+
+
+def save_png(image: Image.Image, file):
+    # palette images are written with the bit depth of their palette
+    options = {'bits': (len(image.getpalette()) // 3 - 1).bit_length()} if image.mode == 'P' else {}
+    image.save(file, format='PNG', **options)
+
+
+FONT_STYLE_WORDS = {'bold', 'italic', 'oblique', 'light', 'medium', 'semibold', 'heavy', 'condensed'}
+
+
+def get_font_file(font_desc: str):
+    """find the file fontconfig uses for a pango font description (None if fontconfig is not available)"""
+    words = font_desc.split()
+    family = ' '.join(w for w in words if w.lower() not in FONT_STYLE_WORDS and not w.isnumeric()) or 'sans-serif'
+    pattern = family + ''.join(f":{w.lower()}" for w in words if w.lower() in FONT_STYLE_WORDS)
+    try:
+        result = subprocess.run(['fc-match', '--format=%{file}', pattern], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout or None
+
+
+def get_font_hashes(font_descs):
+    """content hashes of the font files used for the given font descriptions"""
+    fonts = {}
+    for font_desc in sorted(font_descs):
+        font_file = get_font_file(font_desc)
+        fonts[font_desc] = hash_file(font_file) if font_file else None
+    return fonts
+
+
+def get_render_key(profile: DeviceProfile, color_theme: ColorTheme, grayscale: bool, dither=False):
+    """hash of all settings which influence the rendered images (including the content of the used font files)"""
+    return hash_settings({
+        'profile': asdict(profile), 'grayscale': grayscale, 'dither': dither,
+        'color_theme': asdict(color_theme),
+        'fonts': get_font_hashes({color_theme.text_font, color_theme.time_font, color_theme.meta_font}),
+    })
+
+
+def get_basename(current_time, data):
+    hsh = sha1(f"{current_time}: {data['quote']}::{data['timestring']}::{data['author']}::{data['title']}"
+               .encode('UTF-8')).hexdigest()
+    return f"quote_{current_time.replace(':', '')}_{hsh}"
+
+
+def get_style_dst(dst: Path, index: int):
+    """destination folder of the n-th of several styles: dst, <dst>_other, <dst>_other2, ..."""
+    if index == 0:
+        return dst
+    return dst.with_name(f"{dst.name}_other{index if index > 1 else ''}")
+
+
+class RenderWorker:
+    """
+    Render state of a single process: the Quote2Images are kept and reused for all quotes of that process.
+
+    Each quote is rendered once per device profile and output (color theme, dst, meta_dst) of that profile. Themes
+    which only differ in colors share a Quote2Image, so the font size is searched only once per profile and the
+    solved layout is painted in every theme. The font size solved for the first profile is the starting point of the
+    search for the other ones.
+    """
+    def __init__(self, profiles: list, grayscale=True, dither=False, statistics=False, measure_cache_path=None,
+                 measure_cache_size=DEFAULT_MAXSIZE, measure_cache_key='', credits_cache_size=CREDITS_CACHE_SIZE):
+        self.grayscale = grayscale
+        self.dither = dither
+        self.statistics = statistics
+        # only with a cache file: within a run the same text is rarely measured twice
+        # (the cache key contains the layout width, so all Quote2Images can share it)
+        self.measure_cache = None
+        if measure_cache_path is not None:
+            self.measure_cache = MeasurementCache(measure_cache_path, measure_cache_size, measure_cache_key)
+        self.credits_cache = CreditsCache(credits_cache_size << 20) if credits_cache_size else None
+
+        self.profiles = []  # (name, profile, outputs, Quote2Images)
+        for name, profile, outputs in profiles:
+            q2is = []
+            for color_theme, _, _ in outputs:
+                if not any(q2i.has_same_layout(color_theme) for q2i in q2is):
+                    q2is.append(Quote2Image(profile.width, profile.height, color_theme, margin=profile.margin,
+                                            meta_margin=profile.meta_margin, measure_cache=self.measure_cache,
+                                            credits_cache=self.credits_cache))
+            self.profiles.append((name, profile, outputs, q2is))
+
+    def render(self, job):
+        basename, data = job
+
+        search_time, write_time, files = 0, 0, []
+        credits_hits = self.credits_cache.hits if self.credits_cache is not None else 0
+        t0 = perf_counter()
+        references = {}  # layout key -> Quote2Image which solved the quote first
+        layout_calls = {}
+        for name, profile, outputs, q2is in self.profiles:
+            solved = []
+            for color_theme, dst, meta_dst in outputs:
+                q2i = next(q2i for q2i in q2is if q2i.has_same_layout(color_theme))
+                q2i.set_color_theme(color_theme)
+                if q2i not in solved:
+                    t = perf_counter()
+                    q2i._prepare_quote(data['quote'], data['timestring'])
+                    reference = references.get(q2i.get_layout_key(color_theme))
+                    q2i._find_font_size(None if reference is None else q2i.get_font_size_hint(reference))
+                    references.setdefault(q2i.get_layout_key(color_theme), q2i)
+                    search_time += perf_counter() - t
+                    solved.append(q2i)
+
+                q2i._render_quote()
+                # snapshot before adding the annotations
+                quote_image = surface_to_image(q2i.surface, self.grayscale, profile.gray_depth, self.dither)
+
+                q2i.add_annotations(data['title'], data['author'])
+                credits_image = surface_to_image(q2i.surface, self.grayscale, profile.gray_depth, self.dither)
+
+                t = perf_counter()
+                output_files = [dst / f'{basename}.png', meta_dst / f'{basename}_credits.png']
+                save_png(quote_image, output_files[0])
+                save_png(credits_image, output_files[1])
+                write_time += perf_counter() - t
+                files += output_files
+            layout_calls[name] = sum(q2i.layout_calls for q2i in solved)
+        total_time = perf_counter() - t0
+
+        if not self.statistics:
+            return None
+
+        return Statistics.get_record(next(iter(references.values())), basename) | {
+            'profile_layout_calls': layout_calls,
+            'credits_cache_hits': self.credits_cache.hits - credits_hits if self.credits_cache is not None else 0,
+            'credits_rendered': sum(len(outputs) for _, _, outputs, _ in self.profiles),
+            'font_size_search_time': search_time,
+            'render_time': total_time - search_time - write_time,
+            'write_time': write_time,
+            'total_time': total_time,
+            'bytes_written': sum(f.stat().st_size for f in files),
+        }
+
+
+_render_worker = None  # RenderWorker of the current process (see init_worker)
+
+
+def init_worker(worker_args):
+    global _render_worker
+    _render_worker = RenderWorker(**worker_args)
+    # save the measurements when the process exits (pool processes exit after pool.close())
+    if _render_worker.measure_cache is not None:
+        Finalize(_render_worker, _render_worker.measure_cache.save, exitpriority=10)
+
+
+def render_job(job):
+    """returns (record, None) or (None, error message) if the quote cannot be rendered"""
+    try:
+        return _render_worker.render(job), None
+    except Quote2ImageException as e:
+        return None, str(e)
 
 
 if __name__ == "__main__":
     args = get_arguments()
 
-    # prepare destination folders
-    dst = args['dst']
-    meta_dst = dst / 'metadata'
-    for p in [dst, meta_dst]:
-        p.mkdir(parents=True, exist_ok=True)
-
-    quotes_dict = get_quotes(args['src'])
-
-    statistics = Statistics() if args['statistics'] else None
-
-    missing = []
-    for minute in range(args['start_time'], args['stop_time'] + 1):  # iterate through given minutes of the day
-        current_time = minute_to_timestr(minute)
-        print(f"{current_time}: ", end='')
-        quotes = quotes_dict.get(current_time)
-
-        if quotes is None:
-            missing.append(current_time)
-            print("missing!")
-            continue
-
-        for data in quotes:
-            print(".", end='', flush=True)
-            
-            hsh = sha1(f"{current_time}: {data['quote']}::{data['timestring']}::{data['author']}::{data['title']}".encode('UTF-8')).hexdigest()
-            basename = f"quote_{current_time.replace(':', '')}_{hsh}"
-
-            q2i = Quote2Image(args['width'], args['height'], args['color_theme'])
-
-            q2i.add_quote(data['quote'], data['timestring'])
-            filename = dst / f'{basename}.png'
-            q2i.surface.write_to_png(str(filename))
-            if args['grayscale']:
-                rgb2gray(filename)
-
-            q2i.add_annotations(data['title'], data['author'])
-            filename = meta_dst / f'{basename}_credits.png'
-            q2i.surface.write_to_png(str(filename))
-            if args['grayscale']:
-                rgb2gray(filename)
-
-            if statistics is not None:
-                statistics.add(q2i, basename)
-
-        print()
+    # prepare destination folders (one per profile and style)
+    profiles, outputs, worker_profiles = [], [], []
+    manifests, render_keys = [], []  # per output
+    sharded = args['shard_minutes'] > 0
+    for name, profile in args['profiles']:
+        profile_outputs, worker_outputs = [], []
+        for i, color_theme in enumerate(args['color_themes']):
+            if profile.meta_size is not None:
+                color_theme = replace(color_theme, meta_size=profile.meta_size)
+            dst = get_style_dst(args['dst'] if name is None else args['dst'] / name, i)
+            meta_dst = dst / 'metadata'
+            for p in [dst, meta_dst]:
+                p.mkdir(parents=True, exist_ok=True)
+            profile_outputs.append((color_theme, dst, meta_dst))
+
+            if sharded:
+                # the shards are rendered into a staging folder which is merged into dst when the shard is finished
+                staging = dst / STAGING_NAME
+                shutil.rmtree(staging, ignore_errors=True)  # remains of an interrupted shard
+                (staging / 'metadata').mkdir(parents=True)
+                worker_outputs.append((color_theme, staging, staging / 'metadata'))
+            else:
+                worker_outputs.append((color_theme, dst, meta_dst))
+
+            if args['incremental']:
+                manifests.append(BuildManifest(dst))
+                render_keys.append(get_render_key(profile, color_theme, args['grayscale'], args['dither']))
+        profiles.append((name, profile, profile_outputs))
+        worker_profiles.append((name, profile, worker_outputs))
+        outputs += profile_outputs
+
+    checkpoint, staged_outputs = None, []
+    if sharded:
+        staged_outputs = [output for _, _, worker_outputs in worker_profiles for output in worker_outputs]
+        checkpoint = ShardCheckpoint(args['dst'] / CHECKPOINT_NAME, hash_settings({
+            'source': str(args['src']), 'source_info': get_source_info(args['src'], with_hash=False),
+            'start_time': args['start_time'], 'stop_time': args['stop_time'], 'shard_minutes': args['shard_minutes'],
+            'profiles': [[name, asdict(profile)] for name, profile in args['profiles']],
+            'color_themes': [asdict(color_theme) for color_theme in args['color_themes']],
+            'grayscale': args['grayscale'], 'dither': args['dither'],
+        }))
+        shards = get_shards(args['start_time'], args['stop_time'], args['shard_minutes'])
+    else:
+        shards = [(None, args['start_time'], args['stop_time'])]
+
+    statistics = Statistics() if args['statistics'] or args['report'] else None
+
+    measure_cache_key = ''
+    if args['measure_cache'] is not None:
+        measure_cache_key = hash_settings(get_font_hashes({font_desc for color_theme in args['color_themes']
+                                                           for font_desc in Quote2Image.get_layout_key(color_theme)}))
+
+    def is_current(name):
+        # a quote is only skipped if it is current in all outputs
+        return bool(manifests) and all(
+            manifest.is_current(name, render_key)
+            and (dst / f'{name}.png').exists() and (meta_dst / f'{name}_credits.png').exists()
+            for manifest, render_key, (_, dst, meta_dst) in zip(manifests, render_keys, outputs))
+
+    # only the minutes between start and stop time are parsed
+    corpus = Corpus(args['src'])
+    quotes_dict = dict(corpus.iter_range(args['start_time'], args['stop_time']))
+    corpus.close()
+
+    # iterate through given minutes of the day
+    times = [minute_to_timestr(minute) for minute in range(args['start_time'], args['stop_time'] + 1)]
+    basenames = {current_time: [get_basename(current_time, data) for data in quotes_dict.get(current_time, [])]
+                 for current_time in times}
+    unchanged = {basename for names in basenames.values() for basename in names if is_current(basename)}
+    missing = [current_time for current_time in times if current_time not in quotes_dict]
+
+    worker_args = {
+        'profiles': worker_profiles, 'grayscale': args['grayscale'], 'dither': args['dither'],
+        'statistics': statistics is not None, 'measure_cache_path': args['measure_cache'],
+        'measure_cache_size': args['measure_cache_size'], 'measure_cache_key': measure_cache_key,
+        'credits_cache_size': args['credits_cache_size'],
+    }
+
+    pool = None
+    if args['jobs'] > 1:
+        pool = Pool(args['jobs'], initializer=init_worker, initargs=(worker_args,))
+    else:
+        init_worker(worker_args)
+
+    try:
+        for shard_name, shard_start, shard_stop in shards:
+            shard_times = times[shard_start - args['start_time']:shard_stop - args['start_time'] + 1]
+            if checkpoint is not None and shard_name in checkpoint.done:
+                print(f"{shard_name}: done")
+                continue
+
+            jobs = [(basename, data)
+                    for current_time in shard_times
+                    for basename, data in zip(basenames[current_time], quotes_dict.get(current_time, []))
+                    if basename not in unchanged]
+            if pool is not None:
+                results = pool.imap(render_job, jobs, chunksize=4)  # results are returned in order of the jobs
+            else:
+                results = map(render_job, jobs)
+
+            for current_time in shard_times:
+                print(f"{current_time}: ", end='')
+                if current_time not in quotes_dict:
+                    print("missing!")
+                    continue
+
+                for basename, data in zip(basenames[current_time], quotes_dict[current_time]):
+                    if basename in unchanged:
+                        print("-", end='', flush=True)
+                        continue
+
+                    record, error = next(results)
+                    if error is not None:
+                        if checkpoint is None:
+                            raise Quote2ImageException(error)
+                        # drop the images which have already been rendered for other outputs
+                        for _, staging, meta_staging in staged_outputs:
+                            (staging / f'{basename}.png').unlink(missing_ok=True)
+                            (meta_staging / f'{basename}_credits.png').unlink(missing_ok=True)
+                        checkpoint.quarantine[basename] = {'time': current_time, 'error': error, 'data': data}
+                        print("x", end='', flush=True)
+                        continue
+                    print(".", end='', flush=True)
+
+                    for manifest, render_key in zip(manifests, render_keys):
+                        manifest.add(basename, render_key)
+                    if statistics is not None:
+                        statistics.add(record)
+
+                print()
+
+            if checkpoint is not None:
+                for _, dst, _ in outputs:
+                    merge_staging(dst / STAGING_NAME, dst)
+                for manifest in manifests:
+                    manifest.save()
+                checkpoint.done.add(shard_name)
+                checkpoint.save()
+
+        if pool is not None:
+            pool.close()  # let the processes exit normally, so that they save their measurement cache
+            pool.join()
+        elif _render_worker.measure_cache is not None:
+            _render_worker.measure_cache.save()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        for manifest in manifests:
+            manifest.save()
+
+    if checkpoint is not None:
+        # all shards are finished
+        for _, dst, _ in outputs:
+            shutil.rmtree(dst / STAGING_NAME, ignore_errors=True)
+        quarantine_file = args['dst'] / 'quarantine.yaml'
+        quarantine_file.unlink(missing_ok=True)
+        if checkpoint.quarantine:
+            quarantined = {}
+            for entry in checkpoint.quarantine.values():
+                print(f"quarantined {entry['time']}: {entry['data']['title']}, {entry['data']['author']}")
+                quarantined.setdefault(entry['time'], []).append(entry['data'])
+            write_yaml(dict(sorted(quarantined.items())), quarantine_file)
+            print(f"{len(checkpoint.quarantine)} quotes which could not be rendered written to {quarantine_file}")
+        checkpoint.remove()
+
+    if manifests:
+        # delete images of quotes which have been removed or changed within the given time range
+        def in_time_range(name):
+            return f"{name[6:8]}:{name[8:10]}" in basenames  # name: quote_HHMM_<hash>
+
+        expected = {basename for names in basenames.values() for basename in names}
+        removed = 0
+        for manifest, (_, dst, meta_dst) in zip(manifests, outputs):
+            for path in list(dst.glob('quote_*.png')) + list(meta_dst.glob('quote_*_credits.png')):
+                if in_time_range(path.stem) and path.stem.removesuffix('_credits') not in expected:
+                    path.unlink()
+                    removed += 1
+            for basename in list(manifest.images):
+                if in_time_range(basename) and basename not in expected:
+                    manifest.remove(basename)
+            manifest.save()
+        print(f"removed {removed} outdated images")
+
+    for _, dst, _ in outputs:
+        write_index(dst)
+
+    if args['statistics']:
+        statistics.print_report()
+    if args['report']:
+        statistics.write_report(args['report'])
+        print(f"report written to {args['report']}")
 
     if missing:
         print(f"{len(missing)} missing quotes: {missing}")
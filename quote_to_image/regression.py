@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+from dataclasses import asdict, replace
+from hashlib import sha1
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from pathlib import Path
+
+from PIL import Image, ImageChops, ImageOps
+
+import quotes2images
+from common import EXPECTED_KEYS, Corpus, check_datasets, minute_to_timestr, timestr_to_minute
+from quotes2images import ANNOTATION_MARGIN, DEFAULT_MARGIN, DEVICE_PROFILES, STYLES, ColorTheme, DeviceProfile, \
+    get_basename, get_render_key, render_job
+from quotes2images import init_worker as init_render_worker
+
+BASELINE_VERSION = 1
+TIMING_FACTOR = 1.5  # a quote is reported as slower if it takes this factor longer than in the baseline ...
+TIMING_MIN_DELTA = 0.005  # ... and at least this many seconds longer (shorter differences are noise)
+
+
+def get_args():
+    parser = ArgumentParser(
+        prog='regression',
+        description='Record the font size, a hash of the pixels and the render time of every quote as baseline '
+                    '(--record) or compare the current renderer with a recorded baseline: lists the quotes whose font '
+                    'size or pixels changed and the quotes which render slower. The comparison uses the settings '
+                    'stored in the baseline.',
+    )
+    parser.add_argument('src', help='source file containing quotes in yaml format', type=Path)
+    parser.add_argument('baseline', help='baseline file (json)', type=Path)
+    parser.add_argument('--record', help='record the baseline instead of comparing with it', action='store_true')
+    parser.add_argument('-images', help='record: keep the rendered images in this folder (needed for diff images), '
+                                        'compare: write the changed images and diff images to this folder',
+                        type=Path, default=None)
+    parser.add_argument('-style', help=f'style to record (one of: {list(STYLES.keys())}, default=default)',
+                        type=str, default='default')
+    parser.add_argument('-profile', help=f'device profile to record (one of: {list(DEVICE_PROFILES.keys())}, '
+                                         'default: 600x800 with 8 bit gray depth)', type=str, default=None)
+    parser.add_argument('-start-time', help='optional time to start', type=str, default="00:00")
+    parser.add_argument('-stop-time', help='optional time to stop', type=str, default="23:59")
+    parser.add_argument('-repeat', help='render each quote this many times and keep the fastest render time '
+                                        '(default=1)', type=int, default=1)
+    parser.add_argument('-timing-factor', help=f'report quotes which render this factor slower than in the baseline '
+                                               f'(default={TIMING_FACTOR})', type=float, default=TIMING_FACTOR)
+    parser.add_argument('-jobs', help='number of parallel render processes (0: one per CPU, default=0)',
+                        type=int, default=0)
+
+    parsed = vars(parser.parse_args())
+    if parsed['style'] not in STYLES:
+        raise RuntimeError(f"unknown style {parsed['style']} (one of: {list(STYLES.keys())})")
+    if parsed['profile'] is not None and parsed['profile'] not in DEVICE_PROFILES:
+        raise RuntimeError(f"unknown profile {parsed['profile']} (one of: {list(DEVICE_PROFILES.keys())})")
+    for t in ['start_time', 'stop_time']:
+        parsed[t] = timestr_to_minute(parsed[t])
+    if parsed['start_time'] > parsed['stop_time']:
+        raise RuntimeError("start-time may not be later than stop-time")
+    if parsed['repeat'] < 1:
+        raise RuntimeError("repeat has to be at least 1")
+    parsed['jobs'] = parsed['jobs'] or os.cpu_count() or 1
+    return parsed
+
+
+def get_settings(args):
+    """the settings of a new baseline"""
+    if args['profile'] is None:
+        profile = DeviceProfile(width=600, height=800, margin=DEFAULT_MARGIN, meta_margin=ANNOTATION_MARGIN,
+                                gray_depth=8)
+    else:
+        profile = DEVICE_PROFILES[args['profile']]
+    color_theme = STYLES[args['style']]
+    if profile.meta_size is not None:
+        color_theme = replace(color_theme, meta_size=profile.meta_size)
+    return {
+        'version': BASELINE_VERSION,
+        'profile': asdict(profile), 'color_theme': asdict(color_theme), 'grayscale': True,
+        'render_key': get_render_key(profile, color_theme, True),
+        'start_time': minute_to_timestr(args['start_time']), 'stop_time': minute_to_timestr(args['stop_time']),
+        'images': str(args['images'].absolute()) if args['images'] is not None else None,
+    }
+
+
+def hash_pixels(path: Path):
+    """hash of the decoded image, so it does not depend on the png encoder"""
+    with Image.open(path) as image:
+        return sha1(f"{image.mode}:{image.size}:".encode('UTF-8') + image.tobytes()).hexdigest()
+
+
+def write_diff(baseline_image: Path, image: Path, dst: Path):
+    """write an image which shows the changed pixels in black"""
+    with Image.open(baseline_image) as old, Image.open(image) as new:
+        old, new = old.convert('L'), new.convert('L')
+        if old.size != new.size:
+            return
+        ImageOps.invert(ImageChops.difference(old, new)).save(dst)
+
+
+_scratch = None  # output folder of the current process
+_job_settings = {}
+
+
+def init_worker(settings, repeat, keep):
+    global _scratch
+    _scratch = Path(tempfile.mkdtemp(prefix='regression_'))
+    Finalize(None, shutil.rmtree, args=(_scratch,), kwargs={'ignore_errors': True}, exitpriority=10)
+    outputs = [(ColorTheme(**settings['color_theme']), _scratch, _scratch)]
+    # with the default credits cache, so the images are checked as quotes2images renders them, but without a
+    # measurement cache, so repeated renders measure the font size search instead of cache hits
+    init_args = {'profiles': [(None, DeviceProfile(**settings['profile']), outputs)],
+                 'grayscale': settings['grayscale'], 'statistics': True, 'measure_cache_path': None}
+    init_render_worker(init_args)
+    _job_settings.update(repeat=repeat, keep=keep, baseline_images=settings['images'])
+
+
+def regression_job(job):
+    """render a quote - returns (basename, result) with the result compared to the baseline result (if any)"""
+    basename, time, data, expected = job
+    result = {'time': time, 'title': str(data.get('title')), 'author': str(data.get('author'))}
+    render_times = []
+    credits_cache = quotes2images._render_worker.credits_cache
+    cached_credits = set(credits_cache.entries) if credits_cache is not None else set()
+    for i in range(_job_settings['repeat']):
+        record, error = render_job((basename, data))
+        if error is not None:
+            return basename, result | {'error': error}
+        render_times.append(record['font_size_search_time'] + record['render_time'])
+        if credits_cache is not None and i + 1 < _job_settings['repeat']:
+            # forget the credits rendered by this repeat, so every repeat does the same work as the first one
+            for key in credits_cache.entries.keys() - cached_credits:
+                credits_cache.remove(key)
+
+    files = {'quote': _scratch / f'{basename}.png', 'credits': _scratch / f'{basename}_credits.png'}
+    result |= {'font_size': record['font_size'], 'render_time': min(render_times)}
+    result |= {f'{key}_hash': hash_pixels(path) for key, path in files.items()}
+
+    keep = _job_settings['keep']
+    if expected is not None:
+        changed = [key for key in files if expected.get(f'{key}_hash') != result[f'{key}_hash']]
+        result['changed'] = changed
+        baseline_images = _job_settings['baseline_images']
+        if keep is not None and changed:
+            for key in changed:
+                path = keep / files[key].name
+                shutil.copyfile(files[key], path)
+                if baseline_images is not None and (Path(baseline_images) / path.name).exists():
+                    write_diff(Path(baseline_images) / path.name, path, path.with_name(f'{path.stem}_diff.png'))
+    elif keep is not None:
+        for path in files.values():
+            shutil.copyfile(path, keep / path.name)
+    for path in files.values():
+        path.unlink()
+    return basename, result
+
+
+def run(src: Path, settings: dict, expected: dict, jobs: int, repeat: int, keep: Path = None):
+    """render all quotes of src in the time range of the settings - returns a dict of basename -> result"""
+    corpus = Corpus(src)
+    start, stop = (timestr_to_minute(settings[t]) for t in ['start_time', 'stop_time'])
+    render_jobs, invalid = [], {}
+    for minute in range(start, stop + 1):
+        time = minute_to_timestr(minute)
+        try:
+            datasets, check = corpus.get(time, []), False
+        except Exception:
+            # the minute has invalid quotes: they are recorded as errors, the others are rendered
+            datasets, check = corpus.get(time, [], check=False), True
+        for data in datasets:
+            errors = check_datasets([data]) if check else []
+            if errors:
+                basename = get_basename(time, {key: data.get(key) for key in EXPECTED_KEYS})
+                invalid[basename] = {'time': time, 'title': str(data.get('title')), 'author': str(data.get('author')),
+                                     'error': str(errors[0])}
+                continue
+            basename = get_basename(time, data)
+            render_jobs.append((basename, time, data, expected.get(basename)))
+    corpus.close()
+
+    if keep is not None:
+        keep.mkdir(parents=True, exist_ok=True)
+    init_args = (settings, repeat, keep)
+    if jobs > 1:
+        with Pool(jobs, initializer=init_worker, initargs=init_args) as pool:
+            return invalid | dict(pool.imap(regression_job, render_jobs, chunksize=8))
+    init_worker(*init_args)
+    return invalid | dict(map(regression_job, render_jobs))
+
+
+def compare(baseline: dict, results: dict, timing_factor: float):
+    """print the differences of the results to the baseline - returns the number of quotes with changed output"""
+    def describe(basename, result):
+        return f"  {result['time']} {basename} ({result['title']}, {result['author']})"
+
+    font_sizes, pixels, slower, errors = [], [], [], []
+    for basename, result in results.items():
+        old = baseline.get(basename)
+        if old is None:
+            continue
+        if 'error' in result or 'error' in old:
+            if result.get('error') != old.get('error'):
+                errors.append(f"{describe(basename, result)}: {old.get('error', 'ok')} -> {result.get('error', 'ok')}")
+            continue
+        if result['font_size'] != old['font_size']:
+            font_sizes.append(f"{describe(basename, result)}: {old['font_size']} -> {result['font_size']}")
+        elif result['changed']:
+            pixels.append(f"{describe(basename, result)}: {' and '.join(result['changed'])} image changed")
+        if (result['render_time'] > old['render_time'] * timing_factor
+                and result['render_time'] - old['render_time'] > TIMING_MIN_DELTA):
+            slower.append(f"{describe(basename, result)}: {old['render_time'] * 1000:.1f} ms -> "
+                          f"{result['render_time'] * 1000:.1f} ms")
+    new = sorted(results.keys() - baseline.keys())
+    missing = sorted(baseline.keys() - results.keys())
+
+    for title, lines in [("render errors changed", errors), ("font size changed", font_sizes),
+                         ("pixels changed (same font size)", pixels),
+                         (f"slower than {timing_factor}x the baseline", slower),
+                         ("not in the baseline", [describe(b, results[b]) for b in new]),
+                         ("missing (in the baseline only)", [describe(b, baseline[b]) for b in missing])]:
+        if lines:
+            print(f"{title}: {len(lines)}")
+            for line in lines:
+                print(line)
+
+    common = [b for b in results.keys() & baseline.keys() if 'error' not in results[b] and 'error' not in baseline[b]]
+    if common:
+        old_time = sum(baseline[b]['render_time'] for b in common)
+        new_time = sum(results[b]['render_time'] for b in common)
+        print(f"render time of {len(common)} quotes: {new_time:.2f} s (baseline {old_time:.2f} s, "
+              f"{new_time / old_time - 1:+.1%})")
+    return len(errors) + len(font_sizes) + len(pixels) + len(missing)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args['record']:
+        settings = get_settings(args)
+        results = run(args['src'], settings, {}, args['jobs'], args['repeat'], args['images'])
+        baseline = {'settings': settings, 'quotes': results}
+        tmp = args['baseline'].with_name(args['baseline'].name + '.tmp')
+        with open(tmp, 'w', encoding='utf8') as baseline_file:
+            json.dump(baseline, baseline_file, indent=1, ensure_ascii=False)
+        tmp.replace(args['baseline'])
+        errors = sum(1 for result in results.values() if 'error' in result)
+        print(f"recorded {len(results)} quotes ({errors} cannot be rendered) in {args['baseline']}")
+    else:
+        with open(args['baseline'], encoding='utf8') as baseline_file:
+            baseline = json.load(baseline_file)
+        settings = baseline['settings']
+        if settings.get('version') != BASELINE_VERSION:
+            raise RuntimeError(f"{args['baseline']} is not a baseline of version {BASELINE_VERSION}")
+        profile, color_theme = DeviceProfile(**settings['profile']), ColorTheme(**settings['color_theme'])
+        if get_render_key(profile, color_theme, settings['grayscale']) != settings['render_key']:
+            print("warning: the fonts differ from the ones of the baseline")
+
+        results = run(args['src'], settings, baseline['quotes'], args['jobs'], args['repeat'], args['images'])
+        print(f"compared {len(results)} quotes with {args['baseline']}")
+        if compare(baseline['quotes'], results, args['timing_factor']):
+            sys.exit(1)
+        print("no changes")
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import json
+import os
+import re
+from argparse import ArgumentParser
+from collections import OrderedDict
+from dataclasses import fields, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from multiprocessing import Pool
+from pathlib import Path
+from threading import BoundedSemaphore, Lock
+
+from common import ANNOTATION_MARGIN, Corpus
+from measure_cache import MeasurementCache
+from quotes2images import DEFAULT_MARGIN, STYLES, ColorTheme, Quote2Image, Quote2ImageException, save_png, \
+    surface_to_image
+
+MAX_PENDING_PER_JOB = 4  # requests waiting for a worker process (more are rejected with 503)
+MAX_IMAGE_SIZE = 4096
+MAX_RENDERER_PIXELS = MAX_IMAGE_SIZE * MAX_IMAGE_SIZE  # pixels of the Quote2Images (ARGB surfaces) kept per process
+
+COLOR_PATTERN = re.compile(r'#[0-9a-fA-F]{3,12}|[a-zA-Z ]+')  # pango color (hex or name)
+FONT_PATTERN = re.compile(r'[\w ,.-]*')  # pango font description
+TIME_PATTERN = re.compile(r'\d\d:\d\d')
+
+
+def get_args():
+    parser = ArgumentParser(
+        prog='render_server',
+        description='Render quote images on request: a local http server which keeps the fonts loaded in a pool of '
+                    'render processes. POST a json object to /render to get a png image, e.g. '
+                    '{"quote": "It was ten o\'clock.", "timestring": "ten o\'clock", "title": "T", "author": "A", '
+                    '"style": "dark", "text_color": "grey"} or {"time": "10:00", "index": 0} (requires -src).',
+    )
+    parser.add_argument('-src', help='quote file for requests by time (parsed per minute on demand)', type=Path,
+                        default=None)
+    parser.add_argument('-port', help='port on localhost (default=8765)', type=int, default=8765)
+    parser.add_argument('-jobs', help='number of render processes (0: one per CPU, default=2)', type=int, default=2)
+
+    return vars(parser.parse_args())
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def get_int(request: dict, key: str, default: int, minimum: int, maximum: int):
+    value = request.get(key, default)
+    if not isinstance(value, int) or isinstance(value, bool) or not minimum <= value <= maximum:
+        raise ValueError(f"{key} has to be an integer between {minimum} and {maximum}")
+    return value
+
+
+def get_color_theme(request: dict):
+    """style of the request with the overrides of the request applied"""
+    style = request.get('style', 'default')
+    if style not in STYLES:
+        raise ValueError(f"unknown style {style} (one of: {list(STYLES.keys())})")
+    color_theme = STYLES[style]
+    for field in fields(ColorTheme):
+        value = request.get(field.name)
+        if value is None:
+            continue
+        if field.name == 'background':
+            if not isinstance(value, list) or len(value) != 3 or not all(is_number(v) and 0 <= v <= 1 for v in value):
+                raise ValueError("background has to be a list of 3 numbers between 0 and 1 (RGB)")
+        elif field.name == 'meta_size':
+            if not is_number(value) or not 0 < value <= MAX_IMAGE_SIZE:
+                raise ValueError(f"meta_size has to be a number between 0 and {MAX_IMAGE_SIZE}")
+        elif field.name.endswith('_color'):
+            if not isinstance(value, str) or not COLOR_PATTERN.fullmatch(value):
+                raise ValueError(f"{field.name} has to be a color name or a hex color (e.g. #C0C0C0)")
+        elif not isinstance(value, str) or not FONT_PATTERN.fullmatch(value):
+            raise ValueError(f"{field.name} has to be a font description (e.g. serif bold)")
+        color_theme = replace(color_theme, **{field.name: value})
+    return color_theme
+
+
+_renderers = OrderedDict()  # (width, height, margin, layout key) -> Quote2Image of the current process (LRU)
+_measure_cache = None
+
+
+def init_worker():
+    global _measure_cache
+    _measure_cache = MeasurementCache()
+    render_job({'quote': "It was ten o'clock.", 'timestring': "ten o'clock", 'title': '', 'author': '',
+                'width': 600, 'height': 800, 'margin': DEFAULT_MARGIN, 'grayscale': True, 'gray_depth': 8,
+                'credits': True, 'color_theme': STYLES['default']})  # load the fonts
+
+
+def render_job(job):
+    """render a quote - returns (png bytes, font size)"""
+    color_theme = job['color_theme']
+    width, height, margin = job['width'], job['height'], job['margin']
+    key = width, height, margin, Quote2Image.get_layout_key(color_theme)
+    if key not in _renderers:
+        _renderers[key] = Quote2Image(width, height, color_theme, margin=margin, measure_cache=_measure_cache)
+    _renderers.move_to_end(key)
+    while sum(w * h for w, h, _, _ in _renderers) > MAX_RENDERER_PIXELS:
+        _renderers.popitem(last=False)  # the least recently used (the current one always fits)
+    q2i = _renderers[key]
+
+    q2i.set_color_theme(color_theme)
+    q2i.add_quote(job['quote'], job['timestring'])
+    if job['credits']:
+        q2i.add_annotations(job['title'], job['author'])
+
+    png = BytesIO()
+    save_png(surface_to_image(q2i.surface, job['grayscale'], job['gray_depth']), png)
+    return png.getvalue(), q2i.font_size
+
+
+class RenderServer(ThreadingHTTPServer):
+    def __init__(self, port, pool: Pool, jobs, corpus: Corpus = None):
+        super().__init__(('127.0.0.1', port), RenderRequestHandler)
+        self.pool = pool
+        self.pending = BoundedSemaphore(jobs * MAX_PENDING_PER_JOB)
+        self.corpus = corpus
+        self.corpus_lock = Lock()
+
+    def get_job(self, request: dict):
+        if not isinstance(request, dict):
+            raise ValueError("the request has to be a json object")
+        job = {
+            'width': get_int(request, 'width', 600, 1, MAX_IMAGE_SIZE),
+            'height': get_int(request, 'height', 800, ANNOTATION_MARGIN + 1, MAX_IMAGE_SIZE),
+        }
+        # the text area has to remain: width > 2 * margin and height > ANNOTATION_MARGIN + margin (see
+        # Quote2Image._get_text_area)
+        max_margin = min((job['width'] - 1) // 2, job['height'] - ANNOTATION_MARGIN - 1)
+        job['margin'] = get_int(request, 'margin', DEFAULT_MARGIN, 0, max_margin)
+        for key in ['grayscale', 'credits']:
+            if not isinstance(request.get(key, True), bool):
+                raise ValueError(f"{key} has to be true or false")
+            job[key] = request.get(key, True)
+        if request.get('gray_depth', 8) not in [8, 4]:
+            raise ValueError("gray_depth has to be 8 or 4")
+        job['gray_depth'] = request.get('gray_depth', 8)
+        job['color_theme'] = get_color_theme(request)
+
+        if 'time' in request:
+            if self.corpus is None:
+                raise ValueError("requests by time require a quote file (-src)")
+            if not isinstance(request['time'], str) or not TIME_PATTERN.fullmatch(request['time']):
+                raise ValueError("time has to be given as HH:MM")
+            try:
+                with self.corpus_lock:
+                    datasets = self.corpus.get(request['time'], [])
+            except Exception as e:  # invalid quotes in the quote file
+                raise ValueError(f"invalid quotes for {request['time']}: {e}")
+            index = request.get('index', 0)
+            if not isinstance(index, int) or not 0 <= index < len(datasets):
+                raise ValueError(f"no quote {index} for {request['time']} ({len(datasets)} quotes)")
+            request = datasets[index] | request
+        for key in ['quote', 'timestring']:
+            if key not in request:
+                raise ValueError(f"missing key {key}")
+        job.update({'quote': str(request['quote']), 'timestring': str(request['timestring']),
+                    'title': str(request.get('title', '')), 'author': str(request.get('author', ''))})
+        return job
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    server: RenderServer
+
+    def send_json_error(self, code, message):
+        body = json.dumps({'error': message}).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/render':
+            self.send_json_error(404, f"unknown path {self.path} (use /render)")
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = self.server.get_job(request)
+        except ValueError as e:  # (json errors are ValueErrors)
+            self.send_json_error(400, str(e))
+            return
+
+        if not self.server.pending.acquire(blocking=False):
+            self.send_json_error(503, "too many pending requests")
+            return
+        try:
+            png, font_size = self.server.pool.apply(render_job, (job,))
+        except Quote2ImageException as e:
+            self.send_json_error(422, str(e))
+            return
+        except Exception as e:
+            self.log_error("render error: %r", e)
+            self.send_json_error(500, f"render error: {e}")
+            return
+        finally:
+            self.server.pending.release()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(png)))
+        self.send_header('X-Font-Size', str(font_size))
+        self.end_headers()
+        self.wfile.write(png)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    jobs = args['jobs'] or os.cpu_count() or 1
+
+    corpus = Corpus(args['src']) if args['src'] is not None else None
+    with Pool(jobs, initializer=init_worker) as pool:
+        server = RenderServer(args['port'], pool, jobs, corpus)
+        print(f"rendering on http://127.0.0.1:{args['port']}/render with {jobs} processes")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,56 @@
+import json
+from pathlib import Path
+
+from common import minute_to_timestr
+
+CHECKPOINT_NAME = '.shards.json'
+STAGING_NAME = '.staging'
+
+
+def get_shards(start_minute: int, stop_minute: int, shard_minutes: int):
+    """split a range of minutes (both inclusive) into shards - returns a list of (name, start, stop)"""
+    shards = []
+    for start in range(start_minute, stop_minute + 1, shard_minutes):
+        stop = min(start + shard_minutes - 1, stop_minute)
+        shards.append((f"{minute_to_timestr(start)}-{minute_to_timestr(stop)}", start, stop))
+    return shards
+
+
+class ShardCheckpoint:
+    """
+    Record of the finished shards of a sharded run and of the quotes which could not be rendered (quarantine).
+
+    The checkpoint of a run with other settings (a different key) is ignored.
+    """
+    def __init__(self, path: Path, key: str):
+        self.path = path
+        self.key = key
+        self.done = set()
+        self.quarantine = {}  # basename -> {'time': ..., 'error': ..., 'data': quote data}
+        try:
+            with open(self.path, encoding='utf8') as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except FileNotFoundError:
+            return
+        if state.get('key') == key:
+            self.done = set(state['done'])
+            self.quarantine = state['quarantine']
+
+    def save(self):
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf8') as checkpoint_file:
+            json.dump({'key': self.key, 'done': sorted(self.done), 'quarantine': self.quarantine}, checkpoint_file,
+                      indent=1, ensure_ascii=False)
+        tmp.replace(self.path)
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+
+def merge_staging(staging: Path, dst: Path):
+    """move all files of a staging folder into the corresponding subfolders of dst"""
+    for path in sorted(staging.rglob('*')):
+        if path.is_file():
+            target = dst / path.relative_to(staging)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            path.replace(target)
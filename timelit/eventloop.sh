@@ -3,6 +3,8 @@ set -e
 
 BASEDIR=$(dirname "$(realpath "$0")")
 CLOCK_IS_TICKING="$BASEDIR/clockisticking"
+PACK="$BASEDIR/images.pack"
+. "$BASEDIR/pack.sh"
 
 
 timeZone() {
@@ -14,7 +16,30 @@ timeZone() {
 	"$BASEDIR/timelit.sh"
 }
 
+# showPacked <quote|credits>: show an image of the current quote from the pack (current: "pack HHMM name")
+showPacked() {
+	set -- "$1" $current
+	Entry=$(packEntry "$PACK" "$3" "$4")
+	if [ -n "$Entry" ]; then
+		set -- "$1" $Entry
+		if [ "$1" = "credits" ]; then
+			packExtract "$PACK" "$5" "$6" "$PACK_CREDITS"
+			eips -g "$PACK_CREDITS"
+		else
+			packExtract "$PACK" "$3" "$4" "$PACK_QUOTE"
+			eips -g "$PACK_QUOTE"
+		fi
+	fi
+}
+
 showMeta() {
+    case "$current" in
+        "pack "*)
+            showPacked credits
+            return
+            ;;
+    esac
+
     if [ -n "$current" ]; then
         # find the matching image with metadata
         currentCredit=$(echo "$current" | sed 's/.png//')_credits.png
@@ -26,6 +51,22 @@ showMeta() {
 }
 
 switchMode() {
+	if [ -f "$PACK" ]; then
+		OTHER_PACK="$BASEDIR/images_other.pack"
+		if [ -f "$OTHER_PACK" ]; then
+			mv "$PACK" "$PACK.switching"
+			mv "$OTHER_PACK" "$PACK"
+			mv "$PACK.switching" "$OTHER_PACK"
+
+			case "$current" in
+				"pack "*)
+					showPacked quote
+					;;
+			esac
+		fi
+		return
+	fi
+
 	CURRENT="$BASEDIR/images"
 	OTHER="$BASEDIR/images_other"
 	SUFFIX=".switching"
@@ -0,0 +1,32 @@
+# read images from a pack file created by quote_to_image/pack_images.py (sourced by timelit.sh and eventloop.sh)
+
+# images are extracted to the RAM disk to be shown
+PACK_QUOTE="/tmp/timelit_quote.png"
+PACK_CREDITS="/tmp/timelit_credits.png"
+
+# packEntry <pack> <HHMM> [<name>]
+# print "<name> <offset> <length> <credits offset> <credits length>" of the image with the given name of that minute
+# (a random one if no name is given) - nothing if there is no such image
+packEntry() {
+	awk -v t="$2" -v name="$3" -v seed="$$" '
+		NR == 1 { base = $3; next }
+		$1 == "END" { exit }
+		$1 == t {
+			if (NF < 2) exit
+			if (name == "") {
+				srand(seed)
+				i = 2 + int(rand() * (NF - 1))
+			} else {
+				for (i = 2; i <= NF; i++) if (index($i, name ":") == 1) break
+				if (i > NF) exit
+			}
+			split($i, e, ":")
+			print e[1], base + e[2], e[3], base + e[4], e[5]
+			exit
+		}' "$1"
+}
+
+# packExtract <pack> <offset> <length> <dst>
+packExtract() {
+	tail -c +$(($2 + 1)) "$1" | head -c "$3" > "$4"
+}
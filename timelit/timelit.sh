@@ -16,19 +16,45 @@ elif [ "$OFFSET" -lt 0 ]; then
 fi
 MinuteOTheDay="$(env TZ=$TZ date -R +"%H%M")";
 
-# check if there is at least one image for this minute 
-lines="$(find "$BASEDIR/images/quote_$MinuteOTheDay"* 2>/dev/null | wc -l)"
-if [ "$lines" -eq 0 ]; then
-	echo "no images found for $MinuteOTheDay"
-	exit
+PACK="$BASEDIR/images.pack"
+INDEX="$BASEDIR/images/index.txt"
+if [ -f "$PACK" ]; then
+	# randomly pick an image for that minute from the pack and extract it
+	. "$BASEDIR/pack.sh"
+	Entry=$(packEntry "$PACK" "$MinuteOTheDay")
+	if [ -z "$Entry" ]; then
+		echo "no images found for $MinuteOTheDay"
+		exit
+	fi
+	set -- $Entry
+	ThisMinuteImage="$PACK_QUOTE"
+	packExtract "$PACK" "$2" "$3" "$ThisMinuteImage"
+	# remember the image by its name in the pack (see eventloop.sh)
+	Current="pack $MinuteOTheDay $1"
+elif [ -f "$INDEX" ]; then
+	# randomly pick a png file for that minute from the index (one line per minute: HHMM file...)
+	ThisMinuteImage=$(awk -v t="$MinuteOTheDay" -v seed="$$" \
+		'$1 == t { if (NF > 1) { srand(seed); print $(2 + int(rand() * (NF - 1))) } exit }' "$INDEX")
+	if [ -z "$ThisMinuteImage" ]; then
+		echo "no images found for $MinuteOTheDay"
+		exit
+	fi
+	ThisMinuteImage="$BASEDIR/images/$ThisMinuteImage"
 else
-	echo "$lines files found for $MinuteOTheDay"
-fi
+	# check if there is at least one image for this minute 
+	lines="$(find "$BASEDIR/images/quote_$MinuteOTheDay"* 2>/dev/null | wc -l)"
+	if [ "$lines" -eq 0 ]; then
+		echo "no images found for $MinuteOTheDay"
+		exit
+	else
+		echo "$lines files found for $MinuteOTheDay"
+	fi
 
-# randomly pick a png file for that minute (since we have multiple for some minutes)
-ThisMinuteImage=$( find "$BASEDIR/images/quote_$MinuteOTheDay"* 2>/dev/null | python -c "import sys; import random; print(random.sample(sys.stdin.readlines(), 1)[0].rstrip())")
+	# randomly pick a png file for that minute (since we have multiple for some minutes)
+	ThisMinuteImage=$( find "$BASEDIR/images/quote_$MinuteOTheDay"* 2>/dev/null | python -c "import sys; import random; print(random.sample(sys.stdin.readlines(), 1)[0].rstrip())")
+fi
 
-echo "$ThisMinuteImage" > "$CLOCK_IS_TICKING"
+echo "${Current:-$ThisMinuteImage}" > "$CLOCK_IS_TICKING"
 
 # clear the screen every hour to avoid ghosting
 minute=$(printf "%s" "$MinuteOTheDay" | tail -c 2)